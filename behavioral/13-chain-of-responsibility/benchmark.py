@@ -0,0 +1,85 @@
+# Times F1 presses on the innermost button of a UI nested thousands of levels
+# deep, and hit-testing on a UI with 10^5 components. Run it from this
+# directory: `python benchmark.py [depth]`.
+import random
+import sys
+import time
+
+from main import AbstractComponent, Application, Button, Dialog, Panel
+
+
+def build_ui(depth: int):
+    root = Dialog(0, 0, 800, 600)
+    root.wiki_page_url = "https://www.wikipedia.com/example"
+    container = root
+    for _ in range(depth):
+        panel = Panel(0, 0, 800, 600)
+        container.add(panel)
+        container = panel
+    button = Button(0, 0, 50, 20, "OK")
+    container.add(button)
+    return root, button
+
+
+def press(button: AbstractComponent, presses: int) -> float:
+    start = time.perf_counter()
+    for _ in range(presses):
+        button.show_help()
+    return (time.perf_counter() - start) / presses
+
+
+def benchmark_help(depth: int = 5_000, presses: int = 10_000) -> None:
+    root, button = build_ui(depth)
+    print(f"depth {depth}")
+    print(f"first press     {press(button, 1) * 1e6:10.2f} µs")
+    print(f"cached press    {press(button, presses) * 1e6:10.2f} µs")
+
+    # Uncached: every press walks the whole chain again.
+    uncached = 0.0
+    for _ in range(20):
+        root.wiki_page_url = root.wiki_page_url
+        uncached += press(button, 1)
+    print(f"uncached press  {uncached / 20 * 1e6:10.2f} µs")
+
+    start = time.perf_counter()
+    root.wiki_page_url = "https://www.wikipedia.com/other"
+    print(f"invalidate root {(time.perf_counter() - start) * 1e6:10.2f} µs")
+    print(f"press after it  {press(button, 1) * 1e6:10.2f} µs")
+
+
+# A 4000x2500 dialog holding a 40x25 grid of panels, each with a 10x10 grid of
+# buttons: 101,001 components in total.
+def benchmark_hit_testing(queries: int = 100_000) -> None:
+    app = Application(4000, 2500)
+    start = time.perf_counter()
+    dialog = Dialog(0, 0, 4000, 2500, "Grid")
+    app._components.track(dialog)
+    components = [dialog]
+    for panel_y in range(0, 2500, 100):
+        for panel_x in range(0, 4000, 100):
+            panel = Panel(panel_x, panel_y, 100, 100)
+            dialog.add(panel)
+            components.append(panel)
+            for button_y in range(panel_y, panel_y + 100, 10):
+                for button_x in range(panel_x, panel_x + 100, 10):
+                    button = Button(button_x + 1, button_y + 1, 8, 8, "OK")
+                    panel.add(button)
+                    components.append(button)
+    print(f"{len(components)} components indexed in {time.perf_counter() - start:.2f}s")
+
+    points = [(random.randrange(4000), random.randrange(2500)) for _ in range(queries)]
+    start = time.perf_counter()
+    for x, y in points:
+        app.get_component_at_mouse_coord(x, y)
+    print(f"quadtree     {(time.perf_counter() - start) / queries * 1e6:10.2f} µs/query")
+
+    # Checking every component, for comparison.
+    start = time.perf_counter()
+    for x, y in points[:100]:
+        max((c for c in components if c.contains(x, y)), key=lambda c: c._depth)
+    print(f"linear scan  {(time.perf_counter() - start) / 100 * 1e6:10.2f} µs/query")
+
+
+if __name__ == "__main__":
+    benchmark_help(int(sys.argv[1]) if len(sys.argv) > 1 else 5_000)
+    benchmark_hit_testing()
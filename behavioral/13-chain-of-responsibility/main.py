@@ -1,6 +1,6 @@
 from __future__ import annotations
 from abc import ABC, abstractmethod
-from typing import List
+from typing import List, Optional
 
 # The handler interface declares a method for building a chain of handlers.
 # It also declares a method for executing a request.
@@ -10,6 +10,10 @@ class ComponentWithContextualHelp(ABC):
         pass
 
 
+# Marks a component whose help handler hasn't been looked up yet.
+_UNRESOLVED = object()
+
+
 # The base class for simple components.
 class AbstractComponent(ComponentWithContextualHelp):
     tooltip_text: str = None
@@ -17,31 +21,110 @@ class AbstractComponent(ComponentWithContextualHelp):
     # The component's container acts as the next link in the chain
     _container: AbstractContainer = None
 
+    # Walking up the chain on every F1 press gets expensive in deep UI trees,
+    # so each component remembers which component ended up handling its help
+    # request. Changing any of these attributes invalidates the remembered
+    # handler of the component and of the descendants that depended on it.
+    _help_attributes = frozenset(("tooltip_text", "modal_help_text", "wiki_page_url", "_container"))
+    _help_handler = _UNRESOLVED
+
+    # How many containers this component is nested in, and the hit-testing
+    # index it has been registered with, if any.
+    _depth: int = 0
+    _hit_index: QuadTree = None
+
     def __init__(self, x: int, y: int, width: int, height: int) -> None:
         self.x = x
         self.y = y
         self.width = width
         self.height = height
 
+    def contains(self, x: int, y: int) -> bool:
+        return self.x <= x < self.x + self.width and self.y <= y < self.y + self.height
+
+    def __setattr__(self, name: str, value) -> None:
+        super().__setattr__(name, value)
+        if name in self._help_attributes:
+            self._invalidate_help()
+
     # The component shows a tooltip if there's help text assigned to it.
     # Otherwise it forwards teh call to the container, if it exists.
     def show_help(self) -> str:
-        if (self.tooltip_text):
-            return "This is a tooltip"
-        return self._container.show_help()
+        handler = self._resolve_help_handler()
+        return handler.render_help() if handler is not None else "No help available"
+
+    # Whether this link of the chain handles the request itself...
+    def can_help(self) -> bool:
+        return bool(self.tooltip_text)
+
+    # ...and what it shows when it does.
+    def render_help(self) -> str:
+        return "This is a tooltip"
+
+    def _resolve_help_handler(self) -> Optional[AbstractComponent]:
+        # Iterative on purpose: chains can be much deeper than Python's
+        # recursion limit. Every component walked through remembers the result.
+        walked = []
+        component = self
+        while component is not None and component._help_handler is _UNRESOLVED:
+            if component.can_help():
+                handler = component
+                walked.append(component)
+                break
+            walked.append(component)
+            component = component._container
+        else:
+            handler = component._help_handler if component is not None else None
+        for link in walked:
+            object.__setattr__(link, "_help_handler", handler)
+        return handler
+
+    def _invalidate_help(self) -> None:
+        object.__setattr__(self, "_help_handler", _UNRESOLVED)
+        # Descendants that handle help themselves, or haven't resolved a
+        # handler yet, can't depend on this component; skip their subtrees.
+        pending = list(getattr(self, "_children", ()))
+        while pending:
+            component = pending.pop()
+            handler = component._help_handler
+            if handler is _UNRESOLVED or handler is component:
+                continue
+            object.__setattr__(component, "_help_handler", _UNRESOLVED)
+            pending.extend(getattr(component, "_children", ()))
 
 
 # COntainers can contain both simple components and other containers as children.
 # The chain relationships are established here. The class inheriths show_help
-# behavior from it parent
+# behavior from it parent: a container without help of its own forwards the
+# request to its own container. The outermost one answers with a generic text.
 class AbstractContainer(AbstractComponent):
     _children: List[AbstractComponent]
 
+    def __init__(self, x: int, y: int, width: int, height: int) -> None:
+        super().__init__(x, y, width, height)
+        self._children = []
+
     def add(self, child: AbstractComponent) -> None:
+        if child._container is not None:
+            child._container._children.remove(child)
         self._children.append(child)
         child._container = self
 
-    def show_help(self) -> str:
+        # Keep the depths and the hit-testing index of the new subtree current.
+        pending = [child]
+        while pending:
+            component = pending.pop()
+            component._depth = component._container._depth + 1
+            if self._hit_index is not None and component._hit_index is not self._hit_index:
+                self._hit_index.insert(component)
+            pending.extend(getattr(component, "_children", ()))
+
+    def can_help(self) -> bool:
+        return super().can_help() or self._container is None
+
+    def render_help(self) -> str:
+        if self.tooltip_text:
+            return super().render_help()
         return "This is a container"
 
 
@@ -58,28 +141,135 @@ class Button(AbstractComponent):
 # text can't be provided in a new way, the component can always call the base
 # implementation (see AbstractComponent class)
 class Panel(AbstractContainer):
-    modal_help_text: str
+    modal_help_text: str = None
 
-    def show_help(self) -> str:
+    def can_help(self) -> bool:
+        return bool(self.modal_help_text) or super().can_help()
+
+    def render_help(self) -> str:
         if self.modal_help_text:
             return f"Showing a modal window at ({self.x}, {self.y}) with a width of {self.width} and a height of {self.height} with the help text"
         else:
-            return super().show_help()
+            return super().render_help()
 
 
 class Dialog(AbstractContainer):
-    wiki_page_url: str
+    wiki_page_url: str = None
 
-    def show_help(self) -> str:
+    def __init__(self, x: int, y: int, width: int, height: int, title: str = "") -> None:
+        super().__init__(x, y, width, height)
+        self.title = title
+
+    def can_help(self) -> bool:
+        return bool(self.wiki_page_url) or super().can_help()
+
+    def render_help(self) -> str:
         if self.wiki_page_url:
             return "Opening wiki help page"
         else:
-            return super().show_help()
+            return super().render_help()
+
+
+# A quadtree over the components' rectangles, used to find what is under the
+# mouse without checking every component. It is a "loose" quadtree: each node
+# accepts components that fit in its region grown by half its size on every
+# side, and a component goes to the child its center falls in. That keeps
+# components that straddle a split line from piling up near the root, and a
+# point query still visits at most four nodes per level.
+class QuadTree:
+    _items: List[AbstractComponent]
+    _children: Optional[List[QuadTree]]
+
+    def __init__(self, x: int, y: int, width: int, height: int, capacity: int = 8, max_depth: int = 16, depth: int = 0) -> None:
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.capacity = capacity
+        self.max_depth = max_depth
+        self.depth = depth
+        # Loose bounds: the region grown by half its size on every side.
+        self._left = x - width / 2
+        self._top = y - height / 2
+        self._right = x + width * 1.5
+        self._bottom = y + height * 1.5
+        self._items = []
+        self._children = None
+
+    # Registers a component and everything it contains.
+    def track(self, component: AbstractComponent) -> None:
+        pending = [component]
+        while pending:
+            component = pending.pop()
+            if component._hit_index is not self:
+                self.insert(component)
+            pending.extend(getattr(component, "_children", ()))
+
+    def insert(self, component: AbstractComponent) -> None:
+        component._hit_index = self
+        node = self
+        while node._children is not None:
+            child = node._child_for(component)
+            if child is None:
+                break
+            node = child
+        node._items.append(component)
+        if node._children is None and len(node._items) > node.capacity and node.depth < node.max_depth:
+            node._split()
+
+    def query(self, x: int, y: int) -> List[AbstractComponent]:
+        """Returns every registered component under the point."""
+        found = []
+        pending = [self]
+        while pending:
+            node = pending.pop()
+            for item in node._items:
+                if item.x <= x < item.x + item.width and item.y <= y < item.y + item.height:
+                    found.append(item)
+            if node._children is not None:
+                for child in node._children:
+                    if child._left <= x <= child._right and child._top <= y <= child._bottom:
+                        pending.append(child)
+        return found
+
+    def _split(self) -> None:
+        half_width, half_height = self.width / 2, self.height / 2
+        self._children = [
+            QuadTree(self.x + dx * half_width, self.y + dy * half_height, half_width, half_height,
+                     self.capacity, self.max_depth, self.depth + 1)
+            for dy in (0, 1) for dx in (0, 1)]
+        items, self._items = self._items, []
+        for item in items:
+            child = self._child_for(item)
+            (child._items if child is not None else self._items).append(item)
+
+    # The child whose region holds the component's center, if the component
+    # fits in that child's loose bounds.
+    def _child_for(self, component: AbstractComponent) -> Optional[QuadTree]:
+        center_x = component.x + component.width / 2
+        center_y = component.y + component.height / 2
+        column = 1 if center_x >= self.x + self.width / 2 else 0
+        row = 1 if center_y >= self.y + self.height / 2 else 0
+        child = self._children[row * 2 + column]
+        if (child._loosely_contains(component.x, component.y)
+                and child._loosely_contains(component.x + component.width, component.y + component.height)):
+            return child
+        return None
+
+    def _loosely_contains(self, x: float, y: float) -> bool:
+        return self._left <= x <= self._right and self._top <= y <= self._bottom
 
 
 class Application:
+    _components: QuadTree
+
+    def __init__(self, screen_width: int = 1920, screen_height: int = 1080) -> None:
+        self._components = QuadTree(0, 0, screen_width, screen_height)
+
     def create_ui(self) -> None:
-        dialog = Dialog("Budget Reports")
+        dialog = Dialog(0, 0, 400, 800, "Budget Reports")
+        # From here on, every component added to the dialog is indexed too.
+        self._components.track(dialog)
         dialog.wiki_page_url = "https://www.wikipedia.com/example"
         panel = Panel(0, 0, 400, 800)
         panel.modal_help_text = "This panel does something awesome"
@@ -91,16 +281,19 @@ class Application:
         panel.add(cancel)
         dialog.add(panel)
 
-    def get_component_at_mouse_coord(self, mouse_x: int, mouse_y: int) -> AbstractComponent:
-        new_comp = Button(mouse_x, mouse_y, 10, 10, "OK")
-        new_comp._container = Dialog(100, 200, 10, 10)
-        return new_comp
+    # The innermost component under the mouse is the first link of the chain.
+    def get_component_at_mouse_coord(self, mouse_x: int, mouse_y: int) -> Optional[AbstractComponent]:
+        candidates = self._components.query(mouse_x, mouse_y)
+        return max(candidates, key=lambda component: component._depth, default=None)
 
     def on_f1_key_pressed(self) -> str:
         component = self.get_component_at_mouse_coord(320, 760)
+        if component is None:
+            return "No help available"
         return component.show_help()
 
 
 if __name__ == "__main__":
     app = Application()
-    app.on_f1_key_pressed()
+    app.create_ui()
+    print(app.on_f1_key_pressed())
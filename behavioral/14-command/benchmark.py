@@ -0,0 +1,173 @@
+# Times cut/paste/undo on a large document and measures the memory the undo
+# backups take, types through a bounded history, runs slow commands on the
+# command bus and replays a command journal.
+# Run it from this directory: `python benchmark.py [size_mb] [journaled_commands]`.
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from journal import Journal
+
+from main import Application, CommandBus, CommandHistory, CopyCommand, CutCommand, Editor, PasteCommand, UndoCommand
+
+
+def benchmark_edits(size_mb: int = 100, edits: int = 100_000) -> None:
+    app = Application()
+    editor = app._current_editor = Editor("lorem ipsum " * (size_mb * 2 ** 20 // 12))
+    positions = random.Random(42)
+    commands = []
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    for n in range(edits):
+        offset = positions.randrange(len(editor) - 100)
+        if n % 2 == 0:
+            editor.select(offset, offset + positions.randrange(1, 100))
+            command = CutCommand(app, editor)
+        else:
+            editor.select(offset, offset)
+            command = PasteCommand(app, editor)
+        command.execute()
+        commands.append(command)
+    seconds = time.perf_counter() - start
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{edits} edits on {size_mb} MiB: {seconds / edits * 1e6:.1f} µs/edit, "
+          f"{current / edits:.0f} bytes of history per edit")
+
+    start = time.perf_counter()
+    for command in reversed(commands):
+        command.undo()
+    print(f"{edits} undos: {(time.perf_counter() - start) / edits * 1e6:.1f} µs/undo")
+
+
+# The old approach for comparison: every cut copies the whole document and
+# keeps the previous copy as its backup.
+def benchmark_full_copies(size_mb: int = 100, edits: int = 20) -> None:
+    text = "lorem ipsum " * (size_mb * 2 ** 20 // 12)
+    positions = random.Random(42)
+    backups = []
+    start = time.perf_counter()
+    for _ in range(edits):
+        offset = positions.randrange(len(text) - 100)
+        backups.append(text)
+        text = text[:offset] + text[offset + 50:]
+    print(f"{edits} full-copy edits on {size_mb} MiB: {(time.perf_counter() - start) / edits * 1e6:.1f} µs/edit, "
+          f"{len(text) * edits / 2 ** 20:.0f} MiB of backups")
+
+
+# Types runs of single characters at random places through the bounded history,
+# so adjacent keystrokes merge and old entries fall out of the byte budget.
+def benchmark_history(size_mb: int = 100, keystrokes: int = 100_000) -> None:
+    app = Application()
+    app._history = CommandHistory(max_entries=10_000, max_bytes=2 ** 20)
+    editor = app._current_editor = Editor("lorem ipsum " * (size_mb * 2 ** 20 // 12))
+    positions = random.Random(42)
+    app.clipboard = "x"
+    start = time.perf_counter()
+    for n in range(keystrokes):
+        if n % 20 == 0:
+            offset = positions.randrange(len(editor))
+        editor.select(offset + n % 20, offset + n % 20)
+        app.execute_command(PasteCommand(app, editor))
+    seconds = time.perf_counter() - start
+    print(f"{keystrokes} keystrokes: {seconds / keystrokes * 1e6:.1f} µs/keystroke, history {app._history.stats()}")
+    assert app._history.stats()["bytes"] <= app._history.max_bytes
+
+
+# Journals a session of small cuts, pastes and undos on a 1 MiB document,
+# optionally checkpointing once, and returns the final text.
+def journal_session(journal: Journal, commands: int, checkpoint_at: int = -1) -> str:
+    app = Application(journal=journal)
+    journal.recover(app)
+    editor = app._current_editor = app._editors[0] = Editor("lorem ipsum " * (2 ** 20 // 12))
+    # Opening a document starts from a checkpoint of it.
+    journal.checkpoint(app)
+    app.clipboard = "lorem ipsum "
+    positions = random.Random(42)
+    for n in range(commands):
+        if n == checkpoint_at:
+            journal.checkpoint(app)
+        offset = positions.randrange(len(editor) - 8)
+        if n % 10 == 9:
+            app.undo()
+        elif n % 3 == 0:
+            editor.select(offset, offset + 8)
+            app.execute_command(CutCommand(app, editor))
+        else:
+            editor.select(offset, offset)
+            app.execute_command(PasteCommand(app, editor))
+    journal.close()
+    return editor.text
+
+
+def benchmark_journal(commands: int = 2_000_000) -> None:
+    for label, checkpoint_at in (("journal only", -1), ("checkpoint + tail", commands // 2)):
+        with tempfile.TemporaryDirectory() as directory:
+            journal = Journal(os.path.join(directory, "session.journal"))
+            start = time.perf_counter()
+            text = journal_session(journal, commands, checkpoint_at)
+            seconds = time.perf_counter() - start
+            print(f"{commands} journaled commands: {seconds / commands * 1e6:.1f} µs/command, "
+                  f"{journal.syncs} fsyncs, {journal.stats()['bytes'] / 2 ** 20:.1f} MiB journal")
+
+            start = time.perf_counter()
+            recovered = Application()
+            replayed = Journal(journal.path).recover(recovered)
+            seconds = time.perf_counter() - start
+            assert recovered._current_editor.text == text
+            print(f"Recovery ({label}): {replayed} commands in {seconds:.2f}s, {replayed / seconds:,.0f} commands/s")
+
+
+class SlowPasteCommand(PasteCommand):
+    """A paste that waits a millisecond first, like a command doing I/O."""
+    def execute(self) -> bool:
+        time.sleep(0.001)
+        return super().execute()
+
+
+# Presses 2000 keys spread over 8 editors, every 50th one an undo and every
+# 10th one a copy, the rest pastes, inline and on the command bus. Reports how
+# long the key presses blocked and checks the editors ran in parallel.
+def benchmark_bus(presses: int = 2000, editors: int = 8) -> None:
+    throughput = {}
+    for label, bus in (("inline", False), ("command bus", True)):
+        app = Application()
+        app._editors = [Editor("lorem ipsum " * 1000) for _ in range(editors)]
+        app.clipboard = "lorem ipsum "
+        if bus:
+            app.bus = CommandBus(app)
+        start = time.perf_counter()
+        for n in range(presses):
+            editor = app._editors[n % editors]
+            if n % 50 == 49:
+                app.dispatch(UndoCommand(app, editor))
+            elif n % 10 == 4:
+                app.dispatch(CopyCommand(app, editor))
+            else:
+                app.dispatch(SlowPasteCommand(app, editor))
+        blocked = time.perf_counter() - start
+        if bus:
+            app.bus.close()
+        seconds = time.perf_counter() - start
+        throughput[label] = presses / seconds
+        print(f"{label:<12} {presses} key presses: {blocked / presses * 1e6:8.1f} µs blocked/press, "
+              f"{presses / seconds:8.0f} commands/s")
+        if bus:
+            stats = app.bus.stats()
+            print(f"{'':<12} max queue depth {stats['max_depth']}, "
+                  f"latency mean {stats['mean_latency_us'] / 1000:.1f}ms max {stats['max_latency_us'] / 1000:.1f}ms")
+    if editors > 1:
+        assert throughput["command bus"] > throughput["inline"], throughput
+
+
+if __name__ == "__main__":
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    benchmark_full_copies(size)
+    benchmark_edits(size)
+    benchmark_history(size)
+    benchmark_bus()
+    benchmark_journal(int(sys.argv[2]) if len(sys.argv) > 2 else 2_000_000)
@@ -0,0 +1,248 @@
+# An append-only journal of executed commands, so an editor session survives a
+# crash. Every command that changes a document is appended as one record:
+#
+#   <II  payload length, crc32 of the payload
+#   <BHH kind, editor index, number of edits
+#   then per edit: <III offset, length, byte length of the text, UTF-8 text
+#
+# Every record is handed to the OS as it is appended, so it survives the
+# process crashing. For surviving the machine crashing, records are fsync'ed in
+# batches: every `sync_every` records, and by a background thread at most
+# `sync_interval` seconds after they were appended, even if no more follow.
+# `checkpoint` writes the documents to a snapshot file and starts a new, empty
+# journal generation. `recover` loads the latest snapshot and replays the
+# journal of the same generation, stopping at the first torn record.
+from __future__ import annotations
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from typing import Dict, List, Optional, Tuple, Type
+
+from main import Application, Command, CutCommand, Editor, PasteCommand
+
+HEADER = struct.Struct("<4sHxxQ")
+RECORD = struct.Struct("<II")
+COMMAND = struct.Struct("<BHH")
+EDIT = struct.Struct("<III")
+JOURNAL_MAGIC = b"CJNL"
+CHECKPOINT_MAGIC = b"CCKP"
+VERSION = 1
+
+UNDO = 0
+
+
+class ReplayedCommand(Command):
+    """Stands in for command classes the journal has no kind for. It can be
+    undone like the original, but never executes again."""
+    def execute(self) -> bool:
+        return False
+
+
+KINDS: Dict[Type[Command], int] = {CutCommand: 1, PasteCommand: 2, ReplayedCommand: 255}
+CLASSES: Dict[int, Type[Command]] = {kind: cls for cls, kind in KINDS.items()}
+
+
+class Journal:
+    path: str
+    checkpoint_path: str
+    generation: int
+
+    def __init__(self, path: str, sync_every: int = 256, sync_interval: float = 0.05) -> None:
+        self.path = path
+        self.checkpoint_path = path + ".checkpoint"
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.generation = 0
+        self.records = 0
+        self.syncs = 0
+        self._pending = 0
+        self._last_sync = time.monotonic()
+        self._file = None
+        self._lock = threading.RLock()
+        self._stopped = threading.Event()
+        self._flusher: Optional[threading.Thread] = None
+
+    def record(self, command: Command, editor: int, edits: Optional[List[Tuple[int, int, str]]] = None) -> None:
+        """Appends a command right after it executed, or with the `edits` it
+        made if they were captured then."""
+        if edits is None:
+            edits = command.edits()
+        self._append(KINDS.get(type(command), KINDS[ReplayedCommand]), editor, edits)
+
+    def record_undo(self, command: Command, editor: int) -> None:
+        """Appends the edits that undid `command`."""
+        self._append(UNDO, editor, command.undo_edits())
+
+    def _append(self, kind: int, editor: int, edits: List[Tuple[int, int, str]]) -> None:
+        if self._file is None:
+            raise ValueError("the journal must be recovered before it records commands")
+        parts = [COMMAND.pack(kind, editor, len(edits))]
+        for offset, length, text in edits:
+            data = text.encode("utf-8")
+            parts.append(EDIT.pack(offset, length, len(data)))
+            parts.append(data)
+        payload = b"".join(parts)
+        with self._lock:
+            self._file.write(RECORD.pack(len(payload), zlib.crc32(payload)) + payload)
+            self._file.flush()
+            self.records += 1
+            self._pending += 1
+            if self._pending >= self.sync_every:
+                self.sync()
+
+    def sync(self) -> None:
+        """Makes every record appended so far durable."""
+        with self._lock:
+            if self._file is None or not self._pending:
+                return
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._pending = 0
+            self._last_sync = time.monotonic()
+            self.syncs += 1
+
+    def _flush_periodically(self) -> None:
+        while not self._stopped.wait(self.sync_interval):
+            self.sync()
+
+    def _open(self, mode: str) -> None:
+        self._file = open(self.path, mode)
+        if self._flusher is None:
+            self._stopped.clear()
+            self._flusher = threading.Thread(target=self._flush_periodically, name="journal-sync", daemon=True)
+            self._flusher.start()
+
+    def close(self) -> None:
+        if self._flusher is not None:
+            self._stopped.set()
+            self._flusher.join()
+            self._flusher = None
+        with self._lock:
+            if self._file is not None:
+                self.sync()
+                self._file.close()
+                self._file = None
+
+    def stats(self) -> Dict[str, int]:
+        return {"generation": self.generation, "records": self.records, "syncs": self.syncs,
+                "bytes": os.path.getsize(self.path) if os.path.exists(self.path) else 0}
+
+    def checkpoint(self, app: Application) -> None:
+        """Snapshots every document and starts the next, empty journal
+        generation. The undo history is not part of the snapshot, so after a
+        recovery undo reaches back to the latest checkpoint at most."""
+        self.sync()
+        generation = self.generation + 1
+        texts = [editor.text.encode("utf-8") for editor in app._editors]
+        temporary = self.checkpoint_path + ".tmp"
+        with open(temporary, "wb") as _file:
+            _file.write(HEADER.pack(CHECKPOINT_MAGIC, VERSION, generation))
+            _file.write(struct.pack("<I", len(texts)))
+            for text in texts:
+                _file.write(struct.pack("<Q", len(text)))
+                _file.write(text)
+            _file.flush()
+            os.fsync(_file.fileno())
+        os.replace(temporary, self.checkpoint_path)
+        # A crash right here leaves the previous generation's journal next to
+        # the new checkpoint; recovery sees the older generation and skips it.
+        self._start(generation)
+
+    def recover(self, app: Application) -> int:
+        """Restores `app`'s documents from the latest checkpoint and the journal
+        tail, then opens the journal for appending. Returns how many commands
+        were replayed."""
+        self.close()
+        generation = 0
+        if os.path.exists(self.checkpoint_path):
+            generation = self._load_checkpoint(app)
+
+        replayed, end = 0, HEADER.size
+        if os.path.exists(self.path) and os.path.getsize(self.path) >= HEADER.size:
+            with open(self.path, "rb") as _file:
+                magic, version, journal_generation = HEADER.unpack(_file.read(HEADER.size))
+                if magic != JOURNAL_MAGIC or version != VERSION:
+                    raise ValueError(f"{self.path} is not a command journal")
+                if journal_generation == generation:
+                    replayed, end = self._replay(app, _file)
+        if end == HEADER.size:
+            self._start(generation)
+        else:
+            # Cut off a torn record at the tail, if any, and keep appending.
+            self.generation = generation
+            self._open("r+b")
+            self._file.truncate(end)
+            self._file.seek(end)
+        return replayed
+
+    def _start(self, generation: int) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+            temporary = self.path + ".tmp"
+            with open(temporary, "wb") as _file:
+                _file.write(HEADER.pack(JOURNAL_MAGIC, VERSION, generation))
+                _file.flush()
+                os.fsync(_file.fileno())
+            os.replace(temporary, self.path)
+            self.generation = generation
+            self._open("ab")
+            self._pending = 0
+
+    def _load_checkpoint(self, app: Application) -> int:
+        with open(self.checkpoint_path, "rb") as _file:
+            magic, version, generation = HEADER.unpack(_file.read(HEADER.size))
+            if magic != CHECKPOINT_MAGIC or version != VERSION:
+                raise ValueError(f"{self.checkpoint_path} is not a checkpoint")
+            count, = struct.unpack("<I", _file.read(4))
+            editors = []
+            for _ in range(count):
+                length, = struct.unpack("<Q", _file.read(8))
+                editors.append(Editor(_file.read(length).decode("utf-8")))
+        app._editors = editors or [Editor()]
+        app._current_editor = app._editors[0]
+        app._history = type(app._history)(app._history.max_entries, app._history.max_bytes)
+        return generation
+
+    def _replay(self, app: Application, _file) -> Tuple[int, int]:
+        """Applies every intact record after the header and returns how many
+        there were and where the last one ends."""
+        size = os.fstat(_file.fileno()).st_size
+        if size == HEADER.size:
+            return 0, HEADER.size
+        history = app._history
+        editors = app._editors
+        replayed = 0
+        position = HEADER.size
+        with mmap.mmap(_file.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            while position + RECORD.size <= size:
+                length, checksum = RECORD.unpack_from(view, position)
+                start = position + RECORD.size
+                if start + length > size or zlib.crc32(view[start:start + length]) != checksum:
+                    break
+                kind, editor_index, count = COMMAND.unpack_from(view, start)
+                while editor_index >= len(editors):
+                    editors.append(Editor())
+                editor = editors[editor_index]
+                offset = start + COMMAND.size
+                if kind == UNDO:
+                    for _ in range(count):
+                        at, removed, text_length = EDIT.unpack_from(view, offset)
+                        offset += EDIT.size
+                        editor.replace(at, removed, view[offset:offset + text_length].decode("utf-8"))
+                        offset += text_length
+                    history.pop()
+                else:
+                    command = CLASSES.get(kind, ReplayedCommand)(app, editor)
+                    for _ in range(count):
+                        at, removed, text_length = EDIT.unpack_from(view, offset)
+                        offset += EDIT.size
+                        command.replace(at, removed, view[offset:offset + text_length].decode("utf-8"))
+                        offset += text_length
+                    history.push(command)
+                replayed += 1
+                position = start + length
+        return replayed, position
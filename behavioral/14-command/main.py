@@ -1,6 +1,15 @@
 from __future__ import annotations
+import queue
+import sys
+import threading
+import time
 from abc import ABC, abstractmethod
-from typing import Dict, List, Optional, Callable
+from collections import deque
+from concurrent.futures import Future
+from typing import TYPE_CHECKING, Deque, Dict, List, Optional, Callable, Tuple
+
+if TYPE_CHECKING:
+    from journal import Journal
 
 
 class Button():
@@ -13,6 +22,9 @@ class Button():
 class Shortcuts():
     mapper: Dict[str, Command]
 
+    def __init__(self) -> None:
+        self.mapper = {}
+
     def on_key_press(self, key: str, fun: Callable) -> None:
         self.mapper[key] = fun
 
@@ -20,19 +32,69 @@ class Shortcuts():
 class Command(ABC):
     _app: Application
     _editor: Editor
-    _backup: str
+    _backups: List[Tuple[int, str, int]]
+
+    # Edits touching at most this many characters count as small, and small
+    # edits are merged into one undo step up to `MERGE_LIMIT` characters.
+    SMALL_EDIT = 32
+    MERGE_LIMIT = 1024
+    # Whether the command reads or writes the application's clipboard, which
+    # all editors share.
+    reads_clipboard = False
+    writes_clipboard = False
 
     def __init__(self, app: Application, editor: Editor) -> None:
         self._app = app
         self._editor = editor
+        self._backups = []
 
-    def save_backup(self) -> None:
-        """Make a backup of the editor's state"""
-        self._backup = self._editor.text
+    def replace(self, offset: int, length: int, text: str) -> None:
+        """Replace `length` characters at `offset` with `text`, keeping just
+        the inverse of the edit as a backup: where it happened, the text it
+        removed and how long the inserted text is. Undo then costs as much as
+        the edit itself, not a copy of the whole document."""
+        removed = self._editor.replace(offset, length, text)
+        self._backups.append((offset, removed, len(text)))
 
     def undo(self) -> None:
         """Restore the editor's state"""
-        self._editor.text = self._backup
+        for offset, length, text in self.undo_edits():
+            self._editor.replace(offset, length, text)
+
+    def edits(self) -> List[Tuple[int, int, str]]:
+        """The edits this command made as (offset, length, text) replacements.
+        The inserted text is read back from the editor, so this is only
+        valid right after the command executed."""
+        return [(offset, len(removed), self._editor._text.slice(offset, offset + inserted_length))
+                for offset, removed, inserted_length in self._backups]
+
+    def undo_edits(self) -> List[Tuple[int, int, str]]:
+        """The replacements that revert this command, in the order to apply them."""
+        return [(offset, inserted_length, removed) for offset, removed, inserted_length in reversed(self._backups)]
+
+    def size(self) -> int:
+        """Roughly how many bytes the backups of this command keep alive."""
+        return sys.getsizeof(self) + sum(sys.getsizeof(removed) + 64 for _, removed, _ in self._backups)
+
+    def merge(self, other: Command) -> bool:
+        """Absorb `other` into this command if both are runs of small edits of
+        the same kind next to each other (typing, repeated cuts), so that a
+        single undo reverts all of them."""
+        if type(other) is not type(self) or other._editor is not self._editor:
+            return False
+        if not self._backups or len(other._backups) != 1:
+            return False
+        offset, removed, inserted_length = other._backups[0]
+        if len(removed) + inserted_length > self.SMALL_EDIT:
+            return False
+        if sum(len(r) + i for _, r, i in self._backups) + len(removed) + inserted_length > self.MERGE_LIMIT:
+            return False
+        last_offset, _, last_inserted_length = self._backups[-1]
+        # Right after the previous edit, at the same place, or just before it.
+        if offset not in (last_offset + last_inserted_length, last_offset, last_offset - len(removed)):
+            return False
+        self._backups.extend(other._backups)
+        return True
 
     @abstractmethod
     def execute(self) -> bool:
@@ -45,6 +107,8 @@ class Command(ABC):
 class CopyCommand(Command):
     """The copy command isn't saved to the history since it doesn't change the
     editor's state."""
+    writes_clipboard = True
+
     def execute(self) -> bool:
         self._app.clipboard = self._editor.get_selection()
         return False
@@ -53,9 +117,22 @@ class CopyCommand(Command):
 class CutCommand(Command):
     """Does change the editor's state, therefore it must be save to the history.
     And it'll be saved as long as the method returns true."""
+    writes_clipboard = True
+
+    def execute(self) -> bool:
+        start, end = self._editor.selection
+        self._app.clipboard = self._editor.get_selection()
+        self.replace(start, end - start, "")
+        return True
+
+
+class PasteCommand(Command):
+    """Inserts the clipboard's contents in place of the selection."""
+    reads_clipboard = True
+
     def execute(self) -> bool:
-        self.save_backup()
-        self._editor.replace_selection(self._app.clipboard)
+        start, end = self._editor.selection
+        self.replace(start, end - start, self._app.clipboard)
         return True
 
 
@@ -66,64 +143,448 @@ class UndoCommand(Command):
 
 
 class CommandHistory:
-    """Just a stack"""
-    _history: List[Command]
+    """Just a stack, bounded by a number of entries and by the bytes its
+    commands keep alive. Once over either budget, the oldest entries are
+    forgotten."""
+    _history: Deque[Command]
+
+    def __init__(self, max_entries: int = 1000, max_bytes: int = 64 * 2 ** 20) -> None:
+        self._history = deque()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._bytes = 0
+        self.evictions = 0
+        self.merges = 0
 
     def push(self, c: Command) -> None:
-        """Push the command to the end of the history array"""
+        """Push the command to the end of the history array, or merge it into
+        the last one when they form a run of small edits"""
+        if self._history:
+            last = self._history[-1]
+            size = last.size()
+            if last.merge(c):
+                self._bytes += last.size() - size
+                self.merges += 1
+                self._evict()
+                return
         self._history.append(c)
+        self._bytes += c.size()
+        self._evict()
+
+    def _evict(self) -> None:
+        # Forgets the oldest entries until the history fits its budgets again,
+        # but never the newest, which may be over the byte budget on its own.
+        while len(self._history) > 1 and (len(self._history) > self.max_entries or self._bytes > self.max_bytes):
+            self._bytes -= self._history.popleft().size()
+            self.evictions += 1
 
     def pop(self) -> Optional[Command]:
-        return len(self._history) > 0 and self._history[-1]
+        if not self._history:
+            return None
+        c = self._history.pop()
+        self._bytes -= c.size()
+        return c
+
+    def __len__(self) -> int:
+        return len(self._history)
+
+    def stats(self) -> Dict[str, int]:
+        return {"entries": len(self._history), "bytes": self._bytes,
+                "evictions": self.evictions, "merges": self.merges}
+
+
+class Rope:
+    """The document's text, split into chunks of at most a couple of
+    `CHUNK_SIZE` characters. A Fenwick tree over the chunk lengths finds the
+    chunk holding an offset in O(log n), so an edit only rebuilds one small
+    chunk instead of the whole string."""
+    CHUNK_SIZE = 1 << 16
+    _chunks: List[str]
+    _tree: List[int]
+
+    def __init__(self, text: str = "") -> None:
+        size = self.CHUNK_SIZE
+        self._chunks = [text[i:i + size] for i in range(0, len(text), size)] or [""]
+        self._reindex()
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __str__(self) -> str:
+        return "".join(self._chunks)
+
+    def slice(self, start: int, end: int) -> str:
+        index, offset = self._locate(start)
+        parts = []
+        remaining = end - start
+        while remaining > 0 and index < len(self._chunks):
+            part = self._chunks[index][offset:offset + remaining]
+            parts.append(part)
+            remaining -= len(part)
+            index, offset = index + 1, 0
+        return "".join(parts)
+
+    def insert(self, offset: int, text: str) -> None:
+        if not text:
+            return
+        index, position = self._locate(offset)
+        chunk = self._chunks[index]
+        chunk = chunk[:position] + text + chunk[position:]
+        if len(chunk) <= 2 * self.CHUNK_SIZE:
+            self._chunks[index] = chunk
+            self._grow(index, len(text))
+        else:
+            size = self.CHUNK_SIZE
+            self._chunks[index:index + 1] = [chunk[i:i + size] for i in range(0, len(chunk), size)]
+            self._reindex()
+
+    def delete(self, offset: int, length: int) -> str:
+        """Removes `length` characters at `offset` and returns them."""
+        index, position = self._locate(offset)
+        removed = []
+        emptied = False
+        while length > 0 and index < len(self._chunks):
+            chunk = self._chunks[index]
+            part = chunk[position:position + length]
+            if part:
+                self._chunks[index] = chunk[:position] + chunk[position + len(part):]
+                self._grow(index, -len(part))
+                removed.append(part)
+                length -= len(part)
+                emptied = emptied or not self._chunks[index]
+            index, position = index + 1, 0
+        if emptied and len(self._chunks) > 1:
+            self._chunks = [chunk for chunk in self._chunks if chunk] or [""]
+            self._reindex()
+        return "".join(removed)
+
+    def _reindex(self) -> None:
+        tree = [0] * (len(self._chunks) + 1)
+        for i, chunk in enumerate(self._chunks, 1):
+            tree[i] += len(chunk)
+            parent = i + (i & -i)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self._tree = tree
+        self._length = sum(len(chunk) for chunk in self._chunks)
+
+    def _grow(self, index: int, delta: int) -> None:
+        self._length += delta
+        i = index + 1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+
+    def _locate(self, offset: int) -> Tuple[int, int]:
+        """Returns the chunk holding `offset` and the position inside it."""
+        tree = self._tree
+        count = len(self._chunks)
+        index = 0
+        step = 1 << count.bit_length()
+        while step:
+            if index + step <= count and tree[index + step] <= offset:
+                index += step
+                offset -= tree[index]
+            step >>= 1
+        if index == count:
+            return count - 1, len(self._chunks[-1]) + offset
+        return index, offset
 
 
 class Editor:
     """Holds actual text editing operations. It plays the role of a receiver:
     all commands end up delegating execution to the editor's methods."""
-    text: str
+    _text: Rope
+    selection: Tuple[int, int]
+
+    def __init__(self, text: str = "") -> None:
+        self._text = Rope(text)
+        self.selection = (0, 0)
+
+    @property
+    def text(self) -> str:
+        return str(self._text)
 
-    def get_selection() -> str:
+    def __len__(self) -> int:
+        return len(self._text)
+
+    def select(self, start: int, end: int) -> None:
+        self.selection = (start, end)
+
+    def get_selection(self) -> str:
         """Returns selected text"""
+        return self._text.slice(*self.selection)
 
-    def delete_selection() -> None:
+    def delete_selection(self) -> str:
         """Deletes selected text"""
+        start, end = self.selection
+        return self.replace(start, end - start, "")
 
-    def replace_selection(text: str) -> None:
+    def replace_selection(self, text: str) -> str:
         """Insert the clipboard's contents at the current position"""
+        start, end = self.selection
+        return self.replace(start, end - start, text)
+
+    def replace(self, offset: int, length: int, text: str) -> str:
+        """Replaces `length` characters at `offset` with `text`, leaves the
+        cursor after the inserted text and returns the removed characters."""
+        removed = self._text.delete(offset, length)
+        self._text.insert(offset, text)
+        self.selection = (offset + len(text), offset + len(text))
+        return removed
+
+
+class _Lane:
+    """The queue and worker thread that run one editor's commands in order."""
+
+    def __init__(self, bus: CommandBus, name: str) -> None:
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=bus._work, args=(self.queue,), name=name, daemon=True)
+        self.thread.start()
+
+
+class CommandBus:
+    """Runs commands off the thread that pressed the key. Each editor gets a
+    lane of its own, so its commands execute in submission order while
+    different editors run in parallel. Finished commands are committed to the
+    history and journal in submission order, so undo always reverts the last
+    command submitted before it. Undo waits for every lane to reach it and
+    runs while they are all paused. The clipboard is shared by all editors,
+    so whichever lanes they run on, a command reading it first waits for the
+    last command submitted before it that writes it, and a command writing
+    it for every command using it since then. Pastes still run in parallel."""
+    _lanes: Dict[int, _Lane]
+    # Finished commands waiting for earlier ones to be committed, by sequence number.
+    _finished: Dict[int, Callable[[], None]]
+    # For clipboard commands by sequence number: the events of the earlier
+    # clipboard commands to wait for, and the one to set once done.
+    _clipboard_order: Dict[int, Tuple[List[threading.Event], threading.Event]]
+    # Set once the last clipboard writer submitted so far, and each reader
+    # submitted after it, has run.
+    _clipboard_writer: Optional[threading.Event]
+    _clipboard_readers: List[threading.Event]
+
+    def __init__(self, app: Application) -> None:
+        self._app = app
+        self._lanes = {}
+        self._lock = threading.Lock()
+        self._commit_lock = threading.Lock()
+        self._sequence = 0
+        self._next_commit = 0
+        self._finished = {}
+        self._clipboard_order = {}
+        self._clipboard_writer = None
+        self._clipboard_readers = []
+        self._readers_limit = 64
+        self.submitted = 0
+        self.completed = 0
+        self.depth = 0
+        self.max_depth = 0
+        self._latency = 0.0
+        self.max_latency = 0.0
+        # Latency histogram: bucket `n` counts commands that took less than 2**n µs.
+        self.histogram: Dict[int, int] = {}
+
+    def submit(self, command: Command) -> Future:
+        """Queues `command` and returns a future that completes once the
+        command is in the history."""
+        future: Future = Future()
+        with self._lock:
+            item = (self._sequence, command, future, time.perf_counter())
+            self._sequence += 1
+            self.submitted += 1
+            self.depth += 1
+            self.max_depth = max(self.max_depth, self.depth)
+            if not isinstance(command, UndoCommand):
+                if command.reads_clipboard or command.writes_clipboard:
+                    self._order_clipboard(item[0], command)
+                lane = self._lanes.get(id(command._editor))
+                if lane is None:
+                    lane = self._lanes[id(command._editor)] = _Lane(self, f"editor-{len(self._lanes)}")
+                lane.queue.put(item)
+                return future
+            lanes = list(self._lanes.values())
+            undo = lambda: self._finish(*item, lambda: self._app.execute_command(command))
+            if lanes:
+                # Every lane meets at the barrier, and the last one to arrive runs the undo.
+                barrier = threading.Barrier(len(lanes), action=undo)
+                for lane in lanes:
+                    lane.queue.put(barrier)
+        if not lanes:
+            undo()
+        return future
+
+    def _order_clipboard(self, sequence: int, command: Command) -> None:
+        # Called with the lock held, in submission order.
+        done = threading.Event()
+        after = [] if self._clipboard_writer is None else [self._clipboard_writer]
+        if command.writes_clipboard:
+            after += self._clipboard_readers
+            self._clipboard_writer, self._clipboard_readers = done, []
+        else:
+            readers = self._clipboard_readers
+            if len(readers) >= self._readers_limit:
+                # Forget readers that have run, so pastes without a copy or
+                # cut in between don't pile up.
+                readers[:] = [event for event in readers if not event.is_set()]
+                self._readers_limit = max(64, 2 * len(readers))
+            readers.append(done)
+        self._clipboard_order[sequence] = (after, done)
+
+    def join(self) -> None:
+        """Waits until every submitted command has run."""
+        with self._lock:
+            lanes = list(self._lanes.values())
+        for lane in lanes:
+            lane.queue.join()
+
+    def close(self) -> None:
+        self.join()
+        with self._lock:
+            lanes, self._lanes = list(self._lanes.values()), {}
+        for lane in lanes:
+            lane.queue.put(None)
+            lane.thread.join()
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            return {
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "depth": self.depth,
+                "max_depth": self.max_depth,
+                "lanes": len(self._lanes),
+                "mean_latency_us": self._latency / self.completed * 1e6 if self.completed else 0.0,
+                "max_latency_us": self.max_latency * 1e6,
+                "histogram_us": {f"<{2 ** bucket}": count for bucket, count in sorted(self.histogram.items())},
+            }
+
+    def _work(self, commands: queue.Queue) -> None:
+        while True:
+            item = commands.get()
+            try:
+                if item is None:
+                    return
+                if isinstance(item, threading.Barrier):
+                    item.wait()
+                else:
+                    self._execute(*item)
+            finally:
+                commands.task_done()
+
+    def _execute(self, sequence: int, command: Command, future: Future, submitted: float) -> None:
+        with self._lock:
+            after, done = self._clipboard_order.pop(sequence, ((), None))
+        try:
+            for event in after:
+                event.wait()
+            changed = command.execute()
+        except BaseException as error:
+            self._finish(sequence, command, future, submitted, None, error)
+            return
+        finally:
+            if done is not None:
+                done.set()
+        # The inserted text is read back from the editor, so capture the
+        # edits before this lane moves on to the editor's next command.
+        edits = command.edits() if changed and self._app.journal else None
+        self._finish(sequence, command, future, submitted,
+                     (lambda: self._app.commit(command, edits)) if changed else None)
+
+    def _finish(self, sequence: int, command: Command, future: Future, submitted: float,
+                commit: Optional[Callable[[], None]], error: Optional[BaseException] = None) -> None:
+        def done() -> None:
+            try:
+                if error is not None:
+                    raise error
+                if commit is not None:
+                    commit()
+            except BaseException as failure:
+                future.set_exception(failure)
+            else:
+                future.set_result(None)
+            self._record(time.perf_counter() - submitted)
+
+        with self._commit_lock:
+            self._finished[sequence] = done
+            while self._next_commit in self._finished:
+                self._finished.pop(self._next_commit)()
+                self._next_commit += 1
+
+    def _record(self, latency: float) -> None:
+        with self._lock:
+            self.completed += 1
+            self.depth -= 1
+            self._latency += latency
+            self.max_latency = max(self.max_latency, latency)
+            bucket = int(latency * 1e6).bit_length()
+            self.histogram[bucket] = self.histogram.get(bucket, 0) + 1
 
 
 class Application:
-    _clipboard: str
+    clipboard: str
     _editors: List[Editor]
     _history: CommandHistory
     _current_editor: Editor
     copy_button = Button()
     cut_button = Button()
+    paste_button = Button()
     undo_button = Button()
     shortcuts = Shortcuts()
 
+    def __init__(self, journal: Optional[Journal] = None) -> None:
+        self.clipboard = ""
+        self._current_editor = Editor()
+        self._editors = [self._current_editor]
+        self._history = CommandHistory()
+        self.journal = journal
+        self.bus: Optional[CommandBus] = None
+        # Commands may be committed from the bus's threads as well as inline,
+        # so pushing to the shared history and journal is serialized.
+        self._lock = threading.RLock()
+
     def execute_command(self, c: Command) -> None:
         if (c.execute()):
+            self.commit(c)
+
+    def commit(self, c: Command, edits: Optional[List[Tuple[int, int, str]]] = None) -> None:
+        """Journals an executed command and pushes it to the history."""
+        with self._lock:
+            if self.journal:
+                self.journal.record(c, self._editors.index(c._editor), edits)
             self._history.push(c)
 
+    def dispatch(self, c: Command) -> None:
+        """Runs the command on the bus if there is one, inline otherwise."""
+        if self.bus:
+            self.bus.submit(c)
+        else:
+            self.execute_command(c)
+
     def undo(self) -> None:
         """Take the most recent command from the history and run its undo method.
         Note that we don't know the class of that command. But we don't have to,
         since the command knows how to undo its own action"""
-        command = self._history.pop()
-        if (command):
-            command.undo()
+        with self._lock:
+            command = self._history.pop()
+            if (command):
+                command.undo()
+                if self.journal:
+                    self.journal.record_undo(command, self._editors.index(command._editor))
 
     def create_ui(self) -> None:
         """Creates the application's UI"""
         def copy() -> None:
-            self.execute_command(CopyCommand(self, self._current_editor))
+            self.dispatch(CopyCommand(self, self._current_editor))
 
         def cut() -> None:
-            self.execute_command(CutCommand(self, self._current_editor))
+            self.dispatch(CutCommand(self, self._current_editor))
+
+        def paste() -> None:
+            self.dispatch(PasteCommand(self, self._current_editor))
 
         def undo() -> None:
-            self.execute_command(UndoCommand(self, self._current_editor))
+            self.dispatch(UndoCommand(self, self._current_editor))
 
 
         self.copy_button.set_command(copy)
@@ -132,5 +593,8 @@ class Application:
         self.cut_button.set_command(cut)
         self.shortcuts.on_key_press("Ctrl+X", cut)
 
+        self.paste_button.set_command(paste)
+        self.shortcuts.on_key_press("Ctrl+V", paste)
+
         self.undo_button.set_command(undo)
         self.shortcuts.on_key_press("Ctrl+Z", undo)
@@ -0,0 +1,133 @@
+# Pages through a fake social graph with simulated latency, with and without
+# prefetching, measures how much memory a long traversal holds, how fast the
+# async sender delivers to a local mail sink, what deduplicating merged
+# traversals cost and whether killed runs resume cleanly. Run it from this directory:
+# `python benchmark.py [profiles] [merged_profiles]`.
+import asyncio
+import os
+import resource
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from fake_graph import FakeSocialGraph
+from mail_sink import MailSink
+from main import AsyncMailClient, IteratorCheckpoint, MergedProfileIterator, SeenSet, SocialSpammer, TokenBucket
+
+
+# Each page takes as long to request as its profiles take to handle, so
+# prefetching can hide the latency entirely.
+def benchmark_prefetch(profiles: int = 5000, latency: float = 0.02) -> None:
+    for prefetch in (0, 2):
+        graph = FakeSocialGraph(friends=profiles, latency=latency)
+        start = time.perf_counter()
+        for _ in graph.create_friends_iterator("john.doe", prefetch=prefetch):
+            time.sleep(latency / 100)
+        seconds = time.perf_counter() - start
+        print(f"prefetch={prefetch}  {profiles} profiles in {seconds:.2f}s, {graph.requests} requests")
+
+
+def benchmark_memory(profiles: int = 10 ** 6) -> None:
+    graph = FakeSocialGraph(friends=profiles, latency=0)
+    tracemalloc.start()
+    start = time.perf_counter()
+    count = sum(1 for _ in graph.create_friends_iterator("john.doe", page_size=1000))
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{count} profiles in {seconds:.2f}s, peak {peak / 2 ** 20:.2f} MiB")
+
+
+# Sends to every friend through a mail sink that takes 5ms per batch, one at a
+# time and then batched with several batches in flight, with and without a
+# rate limit.
+async def benchmark_sender(profiles: int = 20_000) -> None:
+    setups = [("one at a time", 1, 1, None), ("batches of 50", 50, 1, None),
+              ("50 x 8 in flight", 50, 8, None), ("rate 20k/s", 50, 8, 20_000)]
+    for label, batch_size, max_in_flight, rate in setups:
+        count = profiles // 10 if batch_size == 1 else profiles
+        async with MailSink(latency=0.005) as sink:
+            mailer = AsyncMailClient(sink.host, sink.port, pool_size=max_in_flight)
+            iterator = FakeSocialGraph(friends=count, latency=0).create_friends_iterator("john.doe")
+            start = time.perf_counter()
+            sent = await SocialSpammer().send_async(
+                iterator, "Very important message", mailer, batch_size, max_in_flight,
+                TokenBucket(rate, burst=batch_size) if rate else None)
+            seconds = time.perf_counter() - start
+            await mailer.close()
+        assert sent == sink.messages == count
+        print(f"{label:<18} {sent:>7} messages  {sent / seconds:10,.0f} msgs/s  {sink.batches} batches")
+
+
+# Merges friends and coworkers lists that share a fifth of their profiles,
+# first remembering seen ids in Bloom filters past 64 MiB, then exactly.
+def benchmark_dedup(profiles: int = 10 ** 7) -> None:
+    overlap = profiles // 5
+    graph = FakeSocialGraph(friends=(profiles + overlap) // 2, coworkers=(profiles + overlap) // 2,
+                            overlap=overlap, latency=0)
+    for label, max_bytes in (("bloom past 64 MiB", 64 * 2 ** 20), ("exact", 2 ** 40)):
+        merged = MergedProfileIterator(graph.create_friends_iterator("john.doe", page_size=1000),
+                                       graph.create_coworkers_iterator("john.doe", page_size=1000),
+                                       seen=SeenSet(max_bytes))
+        start = time.perf_counter()
+        unique = sum(1 for _ in merged)
+        seconds = time.perf_counter() - start
+        stats = merged.seen.stats()
+        print(f"{label:<18} {unique + merged.duplicates} profiles in {seconds:.1f}s "
+              f"({(unique + merged.duplicates) / seconds:,.0f}/s), {merged.duplicates} duplicates skipped "
+              f"({merged.duplicates - overlap} false positives), "
+              f"{stats['bytes'] / 2 ** 20:.0f} MiB seen-set ({stats['mode']}), "
+              f"peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10:.0f} MiB")
+
+
+SPAMMER = """
+import sys
+from fake_graph import FakeSocialGraph
+from main import IteratorCheckpoint, SocialSpammer
+graph = FakeSocialGraph(friends=5000, latency=0.05)
+SocialSpammer().send(graph.create_friends_iterator("john.doe"), "Hi", IteratorCheckpoint(sys.argv[1], 100))
+print(f"requests {graph.requests}")
+"""
+
+
+# Kills a spammer run with SIGKILL a few times and resumes it, then checks that
+# every friend got the message exactly once. Also times checkpointing itself.
+def benchmark_resume(kills: int = 3) -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        state = os.path.join(directory, "spammer.state")
+        output = os.path.join(directory, "spammer.out")
+        with open(output, "w") as _file:
+            for run in range(kills + 1):
+                spammer = subprocess.Popen([sys.executable, "-u", "-c", SPAMMER, state], stdout=_file)
+                if run < kills:
+                    time.sleep(0.5)
+                    spammer.send_signal(signal.SIGKILL)
+                if spammer.wait() == 0:
+                    break
+        with open(output) as _file:
+            lines = _file.read().splitlines()
+        recipients = [line for line in lines if line.startswith("Sending")]
+        # A message being sent at the moment of a kill may go out twice.
+        print(f"{kills} kills: {len(recipients)} messages, {len(set(recipients))} recipients, "
+              f"{lines[-1]} in the last run")
+
+        for interval in (1, 100, 10_000):
+            iterator = FakeSocialGraph(friends=10 ** 5, latency=0).create_friends_iterator("john.doe")
+            checkpoint = IteratorCheckpoint(state, interval)
+            start = time.perf_counter()
+            for _ in iterator:
+                checkpoint.processed(iterator)
+            seconds = time.perf_counter() - start
+            checkpoint.finish()
+            print(f"checkpoint every {interval:>6}: {seconds / 10 ** 5 * 1e6:.1f} µs/profile")
+
+
+if __name__ == "__main__":
+    benchmark_prefetch()
+    asyncio.run(benchmark_sender())
+    benchmark_memory(int(sys.argv[1]) if len(sys.argv) > 1 else 10 ** 6)
+    benchmark_dedup(int(sys.argv[2]) if len(sys.argv) > 2 else 10 ** 7)
+    benchmark_resume()
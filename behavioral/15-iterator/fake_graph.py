@@ -0,0 +1,31 @@
+# A local stand-in for the Facebook social graph, used by the benchmarks. Each
+# request waits `latency` seconds before answering, like a remote service
+# would. Profiles are generated from their position on demand, so lists of
+# millions of profiles cost no memory. Friends are users 0 .. friends - 1 and
+# coworkers continue from there, sharing the last `overlap` friends.
+import threading
+import time
+from typing import Dict
+
+from main import Facebook, Page, Profile
+
+
+class FakeSocialGraph(Facebook):
+    def __init__(self, friends: int = 1000, coworkers: int = 1000, overlap: int = 0,
+                 latency: float = 0.01) -> None:
+        self._sizes: Dict[str, int] = {"friends": friends, "coworkers": coworkers}
+        self._starts: Dict[str, int] = {"friends": 0, "coworkers": friends - overlap}
+        self.latency = latency
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def social_graph_request(self, profile_id: str, type: str, cursor: int = 0, limit: int = 100) -> Page:
+        with self._lock:
+            self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+        size = self._sizes[type]
+        start = self._starts[type]
+        end = min(cursor + limit, size)
+        profiles = [Profile(f"User {n}", f"user{n}") for n in range(start + cursor, start + end)]
+        return profiles, end if end < size else None
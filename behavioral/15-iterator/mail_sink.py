@@ -0,0 +1,58 @@
+# A local stand-in for a mail server, used by the benchmarks. It speaks the
+# line protocol AsyncMailClient uses, waits `latency` seconds before accepting
+# each batch, like a remote server would, and counts what it delivered.
+import asyncio
+from collections import Counter
+from typing import Optional
+
+
+class MailSink:
+    _server: Optional[asyncio.AbstractServer]
+    # How many times each recipient got a message.
+    deliveries: Counter
+
+    def __init__(self, latency: float = 0.005):
+        self.latency = latency
+        self.batches = 0
+        self.deliveries = Counter()
+        self.host = "127.0.0.1"
+        self.port = 0
+        self._server = None
+
+    @property
+    def messages(self) -> int:
+        return sum(self.deliveries.values())
+
+    async def start(self) -> "MailSink":
+        self._server = await asyncio.start_server(self._handle, self.host, 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def close(self) -> None:
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def __aenter__(self) -> "MailSink":
+        return await self.start()
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while line := await reader.readline():
+                command, recipients, length = line.decode().split()
+                await reader.readexactly(int(length))
+                await asyncio.sleep(self.latency)
+                if command == "SEND":
+                    recipients = recipients.split(",")
+                    self.batches += 1
+                    self.deliveries.update(recipients)
+                    writer.write(b"OK %d\n" % len(recipients))
+                else:
+                    writer.write(f"ERR Unknown command {command}\n".encode())
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
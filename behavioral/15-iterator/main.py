@@ -1,7 +1,21 @@
 from __future__ import annotations
+import asyncio
+import json
+import os
+import queue
+import sys
+import threading
+import time
+import weakref
 from abc import ABC, abstractmethod
-from collections.abc import Iterable, Iterator
-from typing import List
+from array import array
+from collections import deque
+from collections.abc import AsyncIterator, Iterable, Iterator
+from functools import partial
+from typing import Callable, Deque, Dict, List, Optional, Set, Tuple
+
+# A page of profiles and the cursor of the page after it, None after the last one.
+Page = Tuple[List["Profile"], Optional[int]]
 
 
 # The collection interface must declare a factory method for creating
@@ -24,14 +38,16 @@ class Facebook(SocialNetwork):
     ################################################
     # Bulk of the collection's code should go here...
     ################################################
-    def social_graph_request(profile_id: str, type: str):
-        pass
+    def social_graph_request(self, profile_id: str, type: str, cursor: int = 0, limit: int = 100) -> Page:
+        """Returns up to `limit` profiles of the `type` list of `profile_id`,
+        starting at `cursor`."""
+        return [], None
 
-    def create_friends_iterator(self, profile_id: str) -> FacebookIterator:
-        return FacebookIterator(self, profile_id, 'friends')
+    def create_friends_iterator(self, profile_id: str, **options) -> FacebookIterator:
+        return FacebookIterator(self, profile_id, 'friends', **options)
 
-    def create_coworkers_iterator(self, profile_id: str) -> FacebookIterator:
-        return FacebookIterator(self, profile_id, 'coworkers')
+    def create_coworkers_iterator(self, profile_id: str, **options) -> FacebookIterator:
+        return FacebookIterator(self, profile_id, 'coworkers', **options)
 
 
 class Profile:
@@ -56,43 +72,406 @@ class ProfileIterator(ABC, Iterator):
     def __next__(self) -> Profile:
         pass
 
+    def close(self) -> None:
+        """Releases whatever the iterator holds; it is exhausted afterwards."""
+
+    def __enter__(self) -> ProfileIterator:
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def __aiter__(self) -> AsyncProfileIterator:
+        return AsyncProfileIterator(self)
+
+
+class AsyncProfileIterator(AsyncIterator):
+    """Iterates a ProfileIterator from a coroutine. Requesting pages blocks,
+    so profiles are taken `chunk` at a time on a worker thread and the event
+    loop keeps running meanwhile."""
+    _profiles: Deque[Profile]
+
+    def __init__(self, iterator: ProfileIterator, chunk: int = 100) -> None:
+        self._iterator = iterator
+        self._chunk = chunk
+        self._profiles = deque()
+
+    def __aiter__(self) -> AsyncProfileIterator:
+        return self
+
+    async def __anext__(self) -> Profile:
+        if not self._profiles:
+            self._profiles.extend(await asyncio.get_running_loop().run_in_executor(None, self._take))
+            if not self._profiles:
+                raise StopAsyncIteration
+        return self._profiles.popleft()
+
+    def _take(self) -> List[Profile]:
+        profiles = []
+        while len(profiles) < self._chunk and self._iterator.has_more():
+            profiles.append(next(self._iterator))
+        return profiles
+
 
 # The common interface for all iterators
 class FacebookIterator(ProfileIterator):
+    """Pages through the graph `page_size` profiles at a time. While a page is
+    consumed, a background thread already requests the following ones, but
+    never holds more than `prefetch` pages ahead of the consumer, so memory
+    stays at a few pages however long the list is. With `prefetch=0` every
+    page is requested when the previous one runs out. The thread stops when
+    the iterator is closed, used as a context manager or garbage collected."""
     _facebook: Facebook
     _profile_id: str
     _type: str
 
     # An iterator object traverses the collection independently from other
-    # iterators. Therefore it has to store the iteration state.
+    # iterators. Therefore it has to store the iteration state: the cursor
+    # the current page was requested with and the position inside it.
     _current_position: int = 0
-    _cache: List[Profile]
+    _cache: Optional[List[Profile]] = None
+    _cursor: int = 0
+    _next_cursor: Optional[int] = 0
+    _pages: Optional[queue.Queue] = None
+    # Profiles to skip when the first page arrives, see `seek`.
+    _skip: int = 0
 
-    def __init__(self, facebook: Facebook, profile_id: str, type: str) -> None:
+    def __init__(self, facebook: Facebook, profile_id: str, type: str,
+                 page_size: int = 100, prefetch: int = 2) -> None:
         self._facebook = facebook
         self._profile_id = profile_id
         self._type = type
+        self._page_size = page_size
+        self._prefetch = prefetch
+        self._stopped = threading.Event()
+        # Stops the prefetch thread, if any, once the iterator is collected.
+        weakref.finalize(self, self._stopped.set)
 
+    @property
+    def key(self) -> str:
+        """Names the list this iterator traverses."""
+        return f"{self._profile_id}/{self._type}"
+
+    def position(self) -> Tuple[int, int]:
+        """The cursor of the current page and the offset of the next profile in it."""
+        if self._cache is None:
+            return self._next_cursor, self._skip
+        return self._cursor, self._current_position
+
+    def seek(self, cursor: int, offset: int) -> None:
+        """Starts the traversal `offset` profiles past the page at `cursor`
+        instead of at the beginning; pages before it are never requested.
+        Only possible before the first profile has been taken."""
+        if self._cache is not None:
+            raise ValueError("the iterator has already started")
+        self._next_cursor, self._skip = cursor, offset
 
     def lazy_init(self):
         if self._cache is None:
-            self._cache = self._facebook.social_graph_request(
-                self._profile_id, self._type)
+            self._load_page()
+            while self._skip:
+                skipped = min(self._skip, len(self._cache) - self._current_position)
+                self._current_position += skipped
+                self._skip -= skipped
+                if self._skip:
+                    if self._next_cursor is None:
+                        self._skip = 0
+                    else:
+                        self._load_page()
+
+    def _request(self, cursor: int) -> Page:
+        return self._facebook.social_graph_request(self._profile_id, self._type, cursor, self._page_size)
 
+    def _start_prefetch(self) -> None:
+        """Starts a prefetch thread at the next page to load."""
+        self._pages = queue.Queue(self._prefetch)
+        # The thread must not reference the iterator, or an abandoned
+        # iterator would never be collected and never stop it.
+        request = partial(self._facebook.social_graph_request, self._profile_id, self._type,
+                          limit=self._page_size)
+        threading.Thread(target=self._fetch_pages, daemon=True,
+                         args=(request, self._pages, self._stopped, self._next_cursor)).start()
+
+    @staticmethod
+    def _fetch_pages(request: Callable[..., Page], pages: queue.Queue, stopped: threading.Event,
+                     cursor: Optional[int]) -> None:
+        """Runs on the prefetch thread, one page ahead of the consumer or more."""
+        def put(item) -> None:
+            # Waits for room in the queue, giving up once the iterator is closed.
+            while not stopped.is_set():
+                try:
+                    pages.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        try:
+            while cursor is not None and not stopped.is_set():
+                profiles, next_cursor = request(cursor=cursor)
+                put((cursor, profiles, next_cursor))
+                cursor = next_cursor
+        except BaseException as error:
+            put(error)
+
+    def _load_page(self) -> None:
+        """Moves on to the next page, or to an empty one after the last."""
+        if self._next_cursor is None:
+            self._cache, self._current_position = [], 0
+            return
+        if self._prefetch and self._pages is None:
+            self._start_prefetch()
+        if self._pages is None:
+            cursor = self._next_cursor
+            profiles, next_cursor = self._request(cursor)
+        else:
+            item = self._pages.get()
+            if isinstance(item, BaseException):
+                # The thread has stopped; the next load starts another one
+                # where this page failed, so the caller may retry.
+                self._pages = None
+                raise item
+            cursor, profiles, next_cursor = item
+        self._cursor, self._cache, self._next_cursor = cursor, profiles, next_cursor
+        self._current_position = 0
 
     def __next__(self):
         """
         The __next__() method must return the next item in the sequence. On
         reaching the end, and in subsequent calls, it must raise StopIteration.
         """
-        if self.has_more():
-            self._current_position += 1
-            return self._cache[self._current_position]
+        if not self.has_more():
+            raise StopIteration
+        profile = self._cache[self._current_position]
+        self._current_position += 1
+        return profile
 
     def has_more(self) -> bool:
         self.lazy_init()
+        # Pages may come back empty before the end of the list.
+        while self._current_position >= len(self._cache) and self._next_cursor is not None:
+            self._load_page()
         return self._current_position < len(self._cache)
 
+    def close(self) -> None:
+        """Stops prefetching; the iterator is exhausted afterwards."""
+        self._stopped.set()
+        self._cache, self._current_position, self._next_cursor = [], 0, None
+
+
+class BloomFilter:
+    """A blocked Bloom filter over 64 bit hashes: each item sets `hashes` bits
+    of a single 64 bit word, so a lookup touches one word. It may claim to
+    have seen an item it hasn't, never the other way round."""
+    _words: array
+
+    def __init__(self, capacity: int, bits_per_item: int = 20, hashes: int = 6) -> None:
+        self.capacity = capacity
+        self.count = 0
+        self._hashes = hashes
+        self._words = array("Q", bytes(8 * max(1, capacity * bits_per_item // 64)))
+
+    def add(self, key: int) -> bool:
+        """Adds a hash and returns whether it was new, as far as the filter can tell."""
+        words = self._words
+        index = key % len(words)
+        # Multiplying by the golden ratio spreads every bit of the key over
+        # the high bits, and each 6 of them pick a bit in the word.
+        bits = ((key * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) >> 16
+        mask = 0
+        for _ in range(self._hashes):
+            mask |= 1 << (bits & 63)
+            bits >>= 6
+        word = words[index]
+        if word & mask == mask:
+            return False
+        words[index] = word | mask
+        self.count += 1
+        return True
+
+    def __contains__(self, key: int) -> bool:
+        bits = ((key * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) >> 16
+        mask = 0
+        for _ in range(self._hashes):
+            mask |= 1 << (bits & 63)
+            bits >>= 6
+        return self._words[key % len(self._words)] & mask == mask
+
+    def nbytes(self) -> int:
+        return len(self._words) * 8
+
+
+class SeenSet:
+    """Remembers which ids have been seen. It keeps their 64 bit hashes in a
+    set until that takes more than `max_bytes`, then moves them into Bloom
+    filters, which take two to three bytes per id but may mistake about one
+    new id in 500 for one already seen. Each filter is twice as large as the one before and
+    gets more bits per item, so the combined error rate stays bounded."""
+    _exact: Optional[Set[int]]
+    _filters: List[BloomFilter]
+
+    # What one more hash in the set costs: its int object plus set slots.
+    ENTRY_BYTES = 32 + 40
+
+    def __init__(self, max_bytes: int = 64 * 2 ** 20, bits_per_item: int = 20) -> None:
+        self.max_bytes = max_bytes
+        self.bits_per_item = bits_per_item
+        self._exact = set()
+        self._filters = []
+        self.count = 0
+
+    def add(self, id: str) -> bool:
+        """Adds an id and returns whether it was new."""
+        key = hash(id) & 0xFFFFFFFFFFFFFFFF
+        if self._exact is not None:
+            if key in self._exact:
+                return False
+            self._exact.add(key)
+            self.count += 1
+            if self.count * self.ENTRY_BYTES > self.max_bytes:
+                self._switch_to_filters()
+            return True
+        filters = self._filters
+        for _filter in filters[:-1]:
+            if key in _filter:
+                return False
+        last = filters[-1]
+        if not last.add(key):
+            return False
+        self.count += 1
+        if last.count >= last.capacity:
+            filters.append(BloomFilter(2 * last.capacity, self.bits_per_item + 2 * len(filters)))
+        return True
+
+    def _switch_to_filters(self) -> None:
+        _filter = BloomFilter(2 * len(self._exact), self.bits_per_item)
+        for key in self._exact:
+            _filter.add(key)
+        self._filters.append(_filter)
+        self._exact = None
+
+    def stats(self) -> Dict[str, int]:
+        if self._exact is not None:
+            return {"mode": "exact", "ids": self.count, "bytes": sys.getsizeof(self._exact) + 32 * len(self._exact)}
+        return {"mode": "bloom", "ids": self.count, "filters": len(self._filters),
+                "bytes": sum(_filter.nbytes() for _filter in self._filters)}
+
+
+class MergedProfileIterator(ProfileIterator):
+    """Walks several profile iterators one after another and returns every
+    profile once, however many of them list it."""
+    _iterators: Deque[ProfileIterator]
+    _next: Optional[Profile] = None
+
+    def __init__(self, *iterators: ProfileIterator, seen: Optional[SeenSet] = None) -> None:
+        self._iterators = deque(iterators)
+        self.seen = seen or SeenSet()
+        self.duplicates = 0
+
+    def has_more(self) -> bool:
+        iterators = self._iterators
+        while self._next is None and iterators:
+            if not iterators[0].has_more():
+                iterators.popleft().close()
+                continue
+            profile = next(iterators[0])
+            if self.seen.add(profile.id):
+                self._next = profile
+            else:
+                self.duplicates += 1
+        return self._next is not None
+
+    def __next__(self) -> Profile:
+        if not self.has_more():
+            raise StopIteration
+        profile, self._next = self._next, None
+        return profile
+
+    def close(self) -> None:
+        while self._iterators:
+            self._iterators.popleft().close()
+        self._next = None
+
+
+class IteratorCheckpoint:
+    """Lets a traversal resume where it stopped. Every `interval` profiles the
+    iterator's position goes to a small state file, written to a temporary
+    file and renamed over the old one so it is never half written. Between
+    checkpoints every processed profile appends a byte to a log next to it,
+    so a resumed traversal also skips what was processed after the last
+    checkpoint. The log starts with a line naming the list, so it is also
+    usable on its own, before the first checkpoint. Only a profile that was
+    being processed at the moment of the crash, and so never recorded, is
+    processed again."""
+
+    def __init__(self, path: str, interval: int = 1000) -> None:
+        self.path = path
+        self.log_path = path + ".log"
+        self.interval = interval
+        self._log: Optional[int] = None
+        self._since_checkpoint = 0
+
+    def restore(self, iterator: FacebookIterator) -> bool:
+        """Moves `iterator` to where the previous run left off, if there was
+        one, and returns whether it did."""
+        if os.path.exists(self.path):
+            with open(self.path) as _file:
+                state = json.load(_file)
+            if state["iterator"] != iterator.key:
+                raise ValueError(f"{self.path} belongs to {state['iterator']}, not {iterator.key}")
+        elif os.path.exists(self.log_path):
+            # Killed before the first checkpoint: the log counts from the start.
+            with open(self.log_path, "rb") as _file:
+                header = _file.readline()
+            if not header.endswith(b"\n"):
+                # Killed while writing the header, before anything was processed.
+                os.remove(self.log_path)
+                return False
+            key = header[:-1].decode()
+            if key != iterator.key:
+                raise ValueError(f"{self.log_path} belongs to {key}, not {iterator.key}")
+            state = {"cursor": 0, "offset": 0, "log": len(header)}
+        else:
+            return False
+        processed = os.path.getsize(self.log_path) - state["log"] if os.path.exists(self.log_path) else 0
+        iterator.seek(state["cursor"], state["offset"] + processed)
+        return True
+
+    def processed(self, iterator: FacebookIterator) -> None:
+        """Records that the profile `iterator` returned last is done."""
+        if self._log is None:
+            self._log = os.open(self.log_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+            if not os.fstat(self._log).st_size:
+                os.write(self._log, iterator.key.encode() + b"\n")
+        os.write(self._log, b"\n")
+        self._since_checkpoint += 1
+        if self._since_checkpoint >= self.interval:
+            self.save(iterator)
+
+    def save(self, iterator: FacebookIterator) -> None:
+        cursor, offset = iterator.position()
+        # The log never shrinks during a traversal, so the state remembers
+        # how long it was; only what comes after counts as processed.
+        state = {"iterator": iterator.key, "cursor": cursor, "offset": offset,
+                 "log": os.path.getsize(self.log_path) if os.path.exists(self.log_path) else 0}
+        temporary = self.path + ".tmp"
+        with open(temporary, "w") as _file:
+            json.dump(state, _file)
+        os.replace(temporary, self.path)
+        self._since_checkpoint = 0
+
+    def close(self) -> None:
+        """Closes the log, keeping both files so a later run can resume."""
+        if self._log is not None:
+            os.close(self._log)
+            self._log = None
+
+    def finish(self) -> None:
+        """Forgets the traversal once it is complete."""
+        self.close()
+        for path in (self.path, self.log_path):
+            if os.path.exists(path):
+                os.remove(path)
+
 
 # Here is another useful trick: You can pass an iterator to a client class
 # instead of giving it acces to a whole collection. This way, you don't
@@ -102,10 +481,144 @@ class FacebookIterator(ProfileIterator):
 # the collection at runtime by passing it a different iterator. This is
 # possible because the client code isn't coupled to the concrete iterator classes.
 class SocialSpammer:
-    def send(self, iterator: ProfileIterator, message: str):
-        while iterator.has_more():
-            profile = next(iterator)
-            print(f'Sending email to {profile}. Message: {message}')
+    def send(self, iterator: ProfileIterator, message: str, checkpoint: Optional[IteratorCheckpoint] = None):
+        """Sends `message` to every profile. With a checkpoint, a run that was
+        killed picks up after the last profile it finished sending to."""
+        if checkpoint is not None:
+            checkpoint.restore(iterator)
+        try:
+            while iterator.has_more():
+                profile = next(iterator)
+                print(f'Sending email to {profile}. Message: {message}')
+                if checkpoint is not None:
+                    checkpoint.processed(iterator)
+        finally:
+            if checkpoint is not None:
+                checkpoint.close()
+        if checkpoint is not None:
+            checkpoint.finish()
+
+    async def send_async(self, iterator: ProfileIterator, message: str, mailer: AsyncMailClient,
+                         batch_size: int = 50, max_in_flight: int = 8,
+                         rate_limit: Optional[TokenBucket] = None) -> int:
+        """Sends `message` to every profile in batches of `batch_size`
+        recipients, with at most `max_in_flight` batches on the wire and, if
+        given, no faster than `rate_limit` allows. Returns how many messages
+        were sent."""
+        slots = asyncio.Semaphore(max_in_flight)
+        sending: Set[asyncio.Task] = set()
+        failures: List[BaseException] = []
+        sent = 0
+
+        async def send_batch(recipients: List[str]) -> None:
+            nonlocal sent
+            try:
+                delivered = await mailer.send(recipients, message)
+                sent += delivered
+            except Exception as error:
+                failures.append(error)
+            finally:
+                slots.release()
+
+        async def flush(recipients: List[str]) -> None:
+            await slots.acquire()
+            if rate_limit is not None:
+                await rate_limit.acquire(len(recipients))
+            task = asyncio.create_task(send_batch(recipients))
+            sending.add(task)
+            task.add_done_callback(sending.discard)
+
+        batch: List[str] = []
+        try:
+            async for profile in iterator:
+                if failures:
+                    break
+                batch.append(profile.id)
+                if len(batch) == batch_size:
+                    await flush(batch)
+                    batch = []
+            if batch and not failures:
+                await flush(batch)
+            await asyncio.gather(*sending)
+        finally:
+            # Stops the iterator prefetching pages nobody will take.
+            iterator.close()
+            # Only left if the iterator or this coroutine was interrupted.
+            for task in list(sending):
+                task.cancel()
+            await asyncio.gather(*sending, return_exceptions=True)
+        if failures:
+            raise failures[0]
+        return sent
+
+
+class TokenBucket:
+    """Allows `rate` tokens per second on average and bursts of up to `burst`.
+    Taking more tokens than there are puts the bucket in debt, and the taker
+    waits until the debt would have been refilled, so a large batch is
+    charged in full without ever exceeding the average rate."""
+
+    def __init__(self, rate: float, burst: float, clock: Callable[[], float] = time.monotonic) -> None:
+        self.rate = rate
+        self.burst = burst
+        self._clock = clock
+        self._tokens = burst
+        self._updated = clock()
+
+    async def acquire(self, tokens: float = 1) -> None:
+        now = self._clock()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        self._tokens -= tokens
+        if self._tokens < 0:
+            await asyncio.sleep(-self._tokens / self.rate)
+
+
+# Mail connector speaking a tiny line protocol: the request is
+# "SEND <recipient,recipient,...> <length>\n" followed by `length` bytes of
+# message, and the response is "<OK|ERR> <count or reason>\n" (see
+# mail_sink.py for a local stand-in).
+class AsyncMailClient:
+    """Keeps up to `pool_size` connections open, each carrying one request
+    at a time, and reuses them while the server keeps them open."""
+    _idle: List[Tuple[asyncio.StreamReader, asyncio.StreamWriter]]
+
+    def __init__(self, host: str, port: int, pool_size: int = 8):
+        self.host = host
+        self.port = port
+        self._idle = []
+        self._slots = asyncio.Semaphore(pool_size)
+
+    async def send(self, recipients: List[str], message: str) -> int:
+        """Sends one message to every recipient and returns how many took it."""
+        body = message.encode()
+        async with self._slots:
+            if self._idle:
+                reader, writer = self._idle.pop()
+            else:
+                reader, writer = await asyncio.open_connection(self.host, self.port)
+            try:
+                writer.write(f"SEND {','.join(recipients)} {len(body)}\n".encode() + body)
+                await writer.drain()
+                line = await reader.readline()
+            except BaseException:
+                writer.close()
+                raise
+            # Without a complete reply the server has closed the connection.
+            if line.endswith(b"\n"):
+                self._idle.append((reader, writer))
+            else:
+                writer.close()
+        status, _, reply = line.decode().rstrip("\n").partition(" ")
+        if status != "OK":
+            raise RuntimeError(reply or "the mail server closed the connection")
+        return int(reply)
+
+    async def close(self) -> None:
+        while self._idle:
+            _, writer = self._idle.pop()
+            writer.close()
+            await writer.wait_closed()
 
 
 if __name__ == '__main__':
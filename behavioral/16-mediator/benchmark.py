@@ -0,0 +1,111 @@
+# Times how long AuthenticationDialog.notify takes to find the handler of an
+# event as the dialog grows to hundreds of components and event kinds,
+# against the chain of comparisons it replaced, and measures login latency
+# and throughput with password hashing inline and on a worker pool. Run it
+# from this directory: `python benchmark.py`.
+import contextlib
+import io
+import os
+import random
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+from main import AuthenticationDialog, Button, Checkbox, Component, Handler, Mediator, TextBox, UserStore
+
+
+# The old way: compare the sender and the event against every case in turn.
+class ChainedDialog(Mediator):
+    _cases: List[Tuple[Component, str, Handler]]
+
+    def __init__(self) -> None:
+        self._cases = []
+
+    def on(self, component: Component, event: str, handler: Handler) -> None:
+        self._cases.append((component, event, handler))
+
+    def notify(self, sender: Component, event: str) -> None:
+        for component, _event, handler in self._cases:
+            if sender == component and event == _event:
+                handler(sender)
+
+
+def make_dialog(users: Optional[UserStore] = None, executor: Optional[ThreadPoolExecutor] = None) -> AuthenticationDialog:
+    return AuthenticationDialog("Log in", Checkbox(), TextBox(), TextBox(), TextBox(), TextBox(), TextBox(),
+                                Button(), Button(), users, executor)
+
+
+def benchmark_notify(components: int, events: int, notifications: int = 20_000) -> None:
+    parts = [TextBox() for _ in range(components)]
+    kinds = [f"event{n}" for n in range(events)]
+    handled = [0]
+
+    def handler(sender: Component) -> None:
+        handled[0] += 1
+
+    picks = random.Random(42)
+    stream = [(picks.choice(parts), picks.choice(kinds)) for _ in range(notifications)]
+    for label, dialog in (("dispatch table", make_dialog()), ("if chain", ChainedDialog())):
+        for part in parts:
+            for kind in kinds:
+                dialog.on(part, kind, handler)
+        start = time.perf_counter()
+        for sender, event in stream:
+            dialog.notify(sender, event)
+        seconds = time.perf_counter() - start
+        print(f"{label:<15} {components:>4} components x {events:>3} events: "
+              f"{seconds / notifications * 1e9:10.0f} ns/notify")
+    assert handled[0] == 2 * notifications
+
+
+# Clicks OK in `attempts` dialogs at once, half with the right password, and
+# measures how long each click blocks the UI thread, how long until its
+# outcome event is handled and how many logins per second go through.
+def benchmark_login(kdf: str, attempts: int = 32, workers: Optional[int] = None) -> None:
+    users = UserStore(kdf)
+    users.add_user("john.doe", "correct horse")
+    executor = ThreadPoolExecutor(workers) if workers else None
+    dialogs = []
+    for n in range(attempts):
+        dialog = make_dialog(users, executor)
+        dialog._login_or_register_chekbox.checked = True
+        dialog._login_username.text = "john.doe"
+        dialog._login_password.text = "correct horse" if n % 2 else "wrong"
+        dialogs.append(dialog)
+
+    blocked, latencies = [], []
+    # Failed logins print their error message; keep them out of the results.
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        for dialog in dialogs:
+            click = time.perf_counter()
+            dialog.notify(dialog._ok_button, "click")
+            blocked.append(time.perf_counter() - click)
+        # The UI thread's event loop: handle outcomes as they arrive.
+        waiting = [dialog for dialog in dialogs if dialog.pending]
+        while waiting:
+            for dialog in waiting:
+                dialog.process_events(timeout=0.001)
+            now = time.perf_counter()
+            latencies += [now - start for dialog in waiting if not dialog.pending]
+            waiting = [dialog for dialog in waiting if dialog.pending]
+        seconds = time.perf_counter() - start
+    if executor is None:
+        latencies = [sum(blocked[:n + 1]) for n in range(attempts)]
+    else:
+        executor.shutdown()
+    assert sum(dialog.user is not None for dialog in dialogs) == attempts // 2
+    label = f"{kdf} {'inline' if executor is None else f'{workers} workers'}"
+    print(f"{label:<18} {attempts} logins: UI blocked {max(blocked) * 1000:7.1f}ms max/click, "
+          f"latency p50 {statistics.median(latencies) * 1000:6.0f}ms max {max(latencies) * 1000:6.0f}ms, "
+          f"{attempts / seconds:5.1f} logins/s")
+
+
+if __name__ == "__main__":
+    for components, events in ((8, 2), (100, 10), (500, 50)):
+        benchmark_notify(components, events)
+    for kdf in ("scrypt", "pbkdf2"):
+        benchmark_login(kdf)
+        for workers in sorted({1, os.cpu_count(), 4 * os.cpu_count()}):
+            benchmark_login(kdf, workers=workers)
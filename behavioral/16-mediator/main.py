@@ -1,5 +1,15 @@
 from __future__ import annotations
+import hashlib
+import hmac
+import os
+import queue
+import threading
 from abc import ABC, abstractmethod
+from concurrent.futures import Executor, Future
+from typing import Callable, Dict, Optional, Tuple
+
+# What the mediator runs for an event, given the component that sent it.
+Handler = Callable[["Component"], None]
 
 # The mediator interface declares a method used by components to notify the
 # mediator about various events. The Mediator may react to these events and
@@ -15,10 +25,72 @@ class Mediator(ABC):
         pass
 
 
+def derive_key(kdf: str, password: str, salt: bytes) -> bytes:
+    """Hashes a password with a deliberately slow KDF. It is the part of
+    checking credentials worth moving off the UI thread, and a module-level
+    function so that a process pool can run it too."""
+    if kdf == "scrypt":
+        return hashlib.scrypt(password.encode(), salt=salt, **UserStore.SCRYPT)
+    return hashlib.pbkdf2_hmac("sha256", password.encode(), salt, UserStore.PBKDF2_ITERATIONS)
+
+
+class UserStore:
+    """Usernames with salted password hashes. Hashing uses a deliberately slow
+    KDF, scrypt or PBKDF2-SHA256, which is why verification belongs off the
+    UI thread: `credentials`, `derive_key` and then `matches` split a check
+    so only the middle step has to run elsewhere, and likewise `derive_key`
+    and `store` for a new account."""
+    _users: Dict[str, Tuple[bytes, bytes]]
+
+    SCRYPT = {"n": 2 ** 14, "r": 8, "p": 1}
+    PBKDF2_ITERATIONS = 600_000
+
+    def __init__(self, kdf: str = "scrypt") -> None:
+        if kdf not in ("scrypt", "pbkdf2"):
+            raise ValueError(f"Unknown KDF {kdf}")
+        self.kdf = kdf
+        self._users = {}
+        self._lock = threading.Lock()
+        # Unknown users are checked against this, so they take as long as known ones.
+        self._dummy = (os.urandom(16), self._hash("", os.urandom(16)))
+
+    def _hash(self, password: str, salt: bytes) -> bytes:
+        return derive_key(self.kdf, password, salt)
+
+    def credentials(self, username: str) -> Tuple[bytes, bytes]:
+        """The salt and hash to check `username`'s password against."""
+        with self._lock:
+            return self._users.get(username, self._dummy)
+
+    def matches(self, username: str, digest: bytes, expected: bytes) -> bool:
+        return hmac.compare_digest(digest, expected) and username in self._users
+
+    def store(self, username: str, salt: bytes, digest: bytes) -> bool:
+        """Creates an account from a hashed password and returns False if
+        the name is taken."""
+        with self._lock:
+            if username in self._users:
+                return False
+            self._users[username] = (salt, digest)
+        return True
+
+    def add_user(self, username: str, password: str) -> bool:
+        """Creates an account and returns False if the name is taken."""
+        salt = os.urandom(16)
+        return self.store(username, salt, self._hash(password, salt))
+
+    def verify(self, username: str, password: str) -> bool:
+        salt, expected = self.credentials(username)
+        return self.matches(username, self._hash(password, salt), expected)
+
+
 # The concrete mediator class. The intertwined web of connections between
 # individual components has been untangled and moved to the mediator
 class AuthenticationDialog(Mediator):
     _title: str
+    # Handlers by (component, event), so an event is dispatched with a single
+    # lookup however many components the dialog has.
+    _handlers: Dict[Tuple[Component, str], Handler]
     _login_or_register_chekbox: Checkbox
     _login_username: TextBox
     _login_password: TextBox
@@ -28,8 +100,26 @@ class AuthenticationDialog(Mediator):
     _ok_button: Button
     _cancel_button: Button
 
-    def __init__(self, title: str, login_or_register_checkbox: Checkbox, login_username: TextBox, login_password: TextBox, registration_username: TextBox, registration_password: TextBox, registration_email: TextBox, ok_button: Button, cancel_button: Button) -> None:
+    # Credentials are checked against `users`. With an `executor`, thread or
+    # process pool, hashing runs there and its outcome comes back as a
+    # 'login_succeeded', 'login_failed', 'registered' or 'registration_failed'
+    # event from the OK button, queued until the UI thread calls
+    # `process_events`. If hashing itself fails, a 'check_failed' event
+    # follows instead and the exception is kept in `failure`.
+    _users: Optional[UserStore]
+    _executor: Optional[Executor]
+    _events: queue.SimpleQueue
+    user: Optional[str] = None
+    error: Optional[str] = None
+    failure: Optional[BaseException] = None
+    pending: bool = False
+
+    def __init__(self, title: str, login_or_register_checkbox: Checkbox, login_username: TextBox, login_password: TextBox, registration_username: TextBox, registration_password: TextBox, registration_email: TextBox, ok_button: Button, cancel_button: Button,
+                 users: Optional[UserStore] = None, executor: Optional[Executor] = None) -> None:
         self._title = title
+        self._users = users
+        self._executor = executor
+        self._events = queue.SimpleQueue()
         self._login_or_register_chekbox = login_or_register_checkbox
         self._login_username = login_username
         self._login_password = login_password
@@ -38,15 +128,11 @@ class AuthenticationDialog(Mediator):
         self._registration_email = registration_email
         self._ok_button = ok_button
         self._cancel_button = cancel_button
+        self._handlers = {}
 
-        self._login_or_register_chekbox.mediator = self
-        self._login_username.mediator = self
-        self._login_password.mediator = self
-        self._registration_username.mediator = self
-        self._registration_password.mediator = self
-        self._registration_email.mediator = self
-        self._ok_button.mediator = self
-        self._cancel_button.mediator = self
+        for component in (login_or_register_checkbox, login_username, login_password, registration_username,
+                          registration_password, registration_email, ok_button, cancel_button):
+            component.dialog = self
         """Create all component objects and pass the current mediator
         into their constructors to establish links.
 
@@ -55,31 +141,111 @@ class AuthenticationDialog(Mediator):
         own or pass the event to the appropriate component.
         """
 
+        self.on(self._login_or_register_chekbox, 'check', self._on_login_or_register_check)
+        self.on(self._ok_button, 'click', self._on_ok_click)
+        self.on(self._ok_button, 'login_succeeded', self._on_logged_in)
+        self.on(self._ok_button, 'registered', self._on_logged_in)
+        self.on(self._ok_button, 'login_failed', self._on_failed)
+        self.on(self._ok_button, 'registration_failed', self._on_failed)
+        self.on(self._ok_button, 'check_failed', self._on_check_failed)
+
+    @property
+    def title(self) -> str:
+        return self._title
+
+    def on(self, component: Component, event: str, handler: Handler) -> None:
+        """Registers `handler` for `event` from `component`, replacing the
+        previous one, and links the component to this dialog."""
+        component.dialog = self
+        self._handlers[component, event] = handler
+
     def notify(self, sender: Component, event: str) -> None:
         """
         The Mediator's notify method is called when one of the components
         sends a notification. The mediator may react to the event and pass
         execution to other components.
         """
-        if sender == self._login_or_register_chekbox and event == 'check':
-            if self._login_or_register_chekbox.checked:
-                title = "Log in"
-                # Show login form components
-            else:
-                title = "Register"
-                # Show registration form components
-                # Hide login form components
-
-        if sender == self._ok_button and event == 'click':
-            if self._login_or_register_chekbox.checked:
-                # Try to find a user with the given username and password
-                found = True
-                if not found:
-                    print("error message above the login field")
-            else:
-                # Create user account with the given username and password
-                # Log user in
-                pass
+        handler = self._handlers.get((sender, event))
+        if handler is not None:
+            handler(sender)
+
+    def _on_login_or_register_check(self, sender: Component) -> None:
+        if self._login_or_register_chekbox.checked:
+            self._title = "Log in"
+            # Show login form components
+        else:
+            self._title = "Register"
+            # Show registration form components
+            # Hide login form components
+
+    def post(self, sender: Component, event: str) -> None:
+        """Queues an event for the UI thread; safe to call from any thread."""
+        self._events.put((sender, event))
+
+    def process_events(self, timeout: Optional[float] = None) -> int:
+        """Runs on the UI thread and notifies every queued event. With a
+        timeout, waits up to that long for the first one. Returns how many
+        events were handled."""
+        handled = 0
+        try:
+            if timeout is not None:
+                self.notify(*self._events.get(timeout=timeout))
+                handled += 1
+            while True:
+                self.notify(*self._events.get_nowait())
+                handled += 1
+        except queue.Empty:
+            return handled
+
+    def _on_ok_click(self, sender: Component) -> None:
+        if self._users is None or self.pending:
+            return
+        if self._login_or_register_chekbox.checked:
+            # Try to find a user with the given username and password
+            username, password = self._login_username.text, self._login_password.text
+            salt, expected = self._users.credentials(username)
+            finish = lambda digest: self._users.matches(username, digest, expected)
+            events = ('login_succeeded', 'login_failed')
+        else:
+            # Create user account with the given username and password
+            # Log user in
+            username, password = self._registration_username.text, self._registration_password.text
+            salt = os.urandom(16)
+            finish = lambda digest: self._users.store(username, salt, digest)
+            events = ('registered', 'registration_failed')
+        self.user, self.error, self.failure = None, None, None
+        self._username = username
+        if self._executor is None:
+            self.notify(sender, events[0] if finish(derive_key(self._users.kdf, password, salt)) else events[1])
+            return
+        future = self._executor.submit(derive_key, self._users.kdf, password, salt)
+        # Only once submitted: if submit raised, nothing would ever clear it.
+        self.pending = True
+
+        def done(future: Future) -> None:
+            try:
+                succeeded = finish(future.result())
+            except BaseException as error:
+                # Not a wrong password: the check itself broke.
+                self.failure = error
+                self.post(sender, 'check_failed')
+                return
+            self.post(sender, events[0] if succeeded else events[1])
+        future.add_done_callback(done)
+
+    def _on_logged_in(self, sender: Component) -> None:
+        self.pending = False
+        self.user = self._username
+
+    def _on_failed(self, sender: Component) -> None:
+        self.pending = False
+        self.error = "Wrong username or password" if self._login_or_register_chekbox.checked else "Username taken"
+        print("error message above the login field")
+
+    def _on_check_failed(self, sender: Component) -> None:
+        self.pending = False
+        self.error = "Could not check the password, please try again"
+        print(f"error message above the login field, {self.failure!r} in the log")
 
 
 # Components communicate with a mediator using the mediator interface. Thanks
@@ -90,9 +256,9 @@ class Component:
     The base component class declares an interface for all concrete
     components.
     """
-    dialog: Mediator
+    dialog: Optional[Mediator]
 
-    def __init__(self, dialog: Mediator) -> None:
+    def __init__(self, dialog: Optional[Mediator] = None) -> None:
         self.dialog = dialog
 
     def click(self) -> None:
@@ -115,9 +281,11 @@ class Button(Component):
     """
     def click(self) -> None:
         print("Button was clicked")
+        super().click()
 
     def keypress(self) -> None:
         print("Button was keypressed")
+        super().keypress()
 
 
 class TextBox(Component):
@@ -125,11 +293,15 @@ class TextBox(Component):
     Concrete Components provide default implementations for the operations
     they support. There might be several variations of these classes.
     """
+    text: str = ""
+
     def click(self) -> None:
         print("TextBox was clicked")
+        super().click()
 
     def keypress(self) -> None:
         print("TextBox was keypressed")
+        super().keypress()
 
 
 class Checkbox(Component):
@@ -137,8 +309,14 @@ class Checkbox(Component):
     Concrete Components provide default implementations for the operations
     they support. There might be several variations of these classes.
     """
+    checked: bool = False
+
     def click(self) -> None:
         print("Checkbox was clicked")
+        self.checked = not self.checked
+        super().click()
+        self.dialog.notify(self, 'check')
 
     def keypress(self) -> None:
         print("Checkbox was keypressed")
+        super().keypress()
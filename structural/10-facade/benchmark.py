@@ -0,0 +1,40 @@
+# Compares the whole-file conversion path with the streaming pipeline on a
+# synthetic video. Run it from this directory: `python benchmark.py [size_mb]`.
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from main import Instrumentation, VideoConverter
+
+
+def measure(label: str, run) -> None:
+    tracemalloc.start()
+    start = time.perf_counter()
+    run()
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:<12} {seconds:8.3f}s  peak {peak / 2 ** 20:8.2f} MiB")
+
+
+def benchmark_convert(size_mb: int = 64) -> None:
+    converter = VideoConverter()
+    with tempfile.TemporaryDirectory() as directory:
+        source = os.path.join(directory, "video.ogg")
+        with open(source, 'wb') as _file:
+            for _ in range(size_mb):
+                _file.write(os.urandom(1 << 20))
+
+        print(f"Converting a {size_mb} MiB video")
+        measure("whole-file", lambda: converter.convert(source, "mp4").save(os.path.join(directory, "whole.mp4")))
+        measure("streaming", lambda: converter.convert_stream(source, "mp4", os.path.join(directory, "stream.mp4")))
+
+        converter = VideoConverter(instrumentation=Instrumentation())
+        measure("instrumented", lambda: converter.convert_stream(source, "mp4", os.path.join(directory, "stream.mp4")))
+        print(converter.instrumentation.summary())
+
+
+if __name__ == "__main__":
+    benchmark_convert(int(sys.argv[1]) if len(sys.argv) > 1 else 64)
@@ -1,19 +1,187 @@
+import hashlib
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Iterable, Iterator, List, Optional, TypeVar
+
 from video_conversion_framework import *
 
 # Facade class to hide framework's complexity behind a simple interface. Tradeoff between funcionality and simplicity.
 class VideoConverter:
+    cache_dir: str
+    # Pass an `Instrumentation()` to find out which stage is the bottleneck.
+    instrumentation: Instrumentation
+
+    def __init__(self, cache_dir: str = ".conversion-cache", instrumentation: Instrumentation = DISABLED) -> None:
+        self.cache_dir = cache_dir
+        self.instrumentation = instrumentation
+
     def convert(self, filename: str, _format: str) -> File:
         _file = VideoFile(filename)
-        sourceCodec = CodecFactory.extract(_file)
+        sourceCodec = CodecFactory(self.instrumentation).extract(_file)
+        destinationCodec = self._destination_codec(_format)
+
+        reader = BitrateReader(self.instrumentation)
+        buffer = reader.read(filename, sourceCodec)
+        result = reader.convert(buffer, destinationCodec)
+        result = (AudioMixer(self.instrumentation)).fix(result)
+        return File(f"{os.path.splitext(filename)[0]}.{_format}", result, self.instrumentation)
+
+    # Same conversion, but the subsystem is driven as a pipeline of chunks:
+    # read -> convert -> mix -> write. Every stage runs on its own thread and
+    # talks to the next one through a queue holding at most `queue_size`
+    # chunks, so a slow stage makes the previous ones wait instead of piling
+    # up data. Memory stays around `chunk_size * queue_size` per stage no
+    # matter how long the video is.
+    def convert_stream(self, filename: str, _format: str, output: str, chunk_size: int = 1 << 16, queue_size: int = 4) -> None:
+        sourceCodec = CodecFactory(self.instrumentation).extract(VideoFile(filename))
+        destinationCodec = self._destination_codec(_format)
+
+        reader = BitrateReader(self.instrumentation)
+        chunks = _threaded(reader.read_chunks(filename, sourceCodec, chunk_size), queue_size)
+        chunks = _threaded(reader.convert_chunks(chunks, destinationCodec), queue_size)
+        mixed = _threaded((AudioMixer(self.instrumentation)).fix_chunks(chunks), queue_size)
+        try:
+            with open(output, 'wb') as _file:
+                for data in mixed:
+                    with self.instrumentation.stage("save") as stage:
+                        stage.bytes = _file.write(data)
+        finally:
+            # Stops the stages if writing failed.
+            mixed.close()
+
+    def _destination_codec(self, _format: str) -> Codec:
         if (_format == "mp4"):
-            destinationCodec = MPEG4CompressionCodec()
-        else:
-            destinationCodec = OggCompressionCodec()
-
-        buffer = BitrateReader.read(filename, sourceCodec)
-        result = BitrateReader.convert(buffer, destinationCodec)
-        result = (AudioMixer()).fix(result)
-        return File(result)
+            return MPEG4CompressionCodec()
+        return OggCompressionCodec()
+
+    # The facade can also hide how a batch of conversions is scheduled. Jobs are
+    # fanned out over a pool of at most `max_workers` processes, and results are
+    # kept in an on-disk cache keyed by the source's content hash and the target
+    # format, so converting the same video twice only costs a hash. A job that
+    # fails doesn't stop the batch; its error is recorded on its ConversionJob.
+    def convert_many(self, paths: Iterable[str], _format: str, max_workers: Optional[int] = None) -> List["ConversionJob"]:
+        os.makedirs(self.cache_dir, exist_ok=True)
+        paths = list(paths)
+        jobs: List[Optional[ConversionJob]] = [None] * len(paths)
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            futures = {pool.submit(_convert_job, path, _format, self.cache_dir): index
+                       for index, path in enumerate(paths)}
+            for future in as_completed(futures):
+                index = futures[future]
+                error = future.exception()
+                if error is None:
+                    jobs[index] = future.result()
+                else:
+                    # The worker itself died; there is no timing to report.
+                    jobs[index] = ConversionJob(paths[index], _format, None, False, 0.0, repr(error))
+        return jobs
+
+
+T = TypeVar("T")
+_DONE = object()
+
+
+class _StageError:
+    def __init__(self, error: BaseException) -> None:
+        self.error = error
+
+
+# Consumes `iterable` on a background thread and hands its items over through a
+# bounded queue. Errors raised by the stage are re-raised on the consumer side.
+# If the consumer stops early, the producer notices within `poll` seconds,
+# closes `iterable` (and with it the stages and files behind it) and exits.
+def _threaded(iterable: Iterable[T], maxsize: int, poll: float = 0.1) -> Iterator[T]:
+    items: queue.Queue = queue.Queue(maxsize)
+    stopped = threading.Event()
+
+    def put(item: object) -> bool:
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=poll)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce() -> None:
+        try:
+            for item in iterable:
+                if not put(item):
+                    break
+        except BaseException as error:
+            put(_StageError(error))
+        finally:
+            close = getattr(iterable, "close", None)
+            if close is not None:
+                close()
+            put(_DONE)
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item = items.get()
+            if item is _DONE:
+                return
+            if isinstance(item, _StageError):
+                raise item.error
+            yield item
+    finally:
+        stopped.set()
+
+
+# The outcome of a single conversion inside a batch.
+class ConversionJob:
+    path: str
+    format: str
+    output: Optional[str]
+    cached: bool
+    seconds: float
+    # Why the conversion failed, None if it succeeded.
+    error: Optional[str]
+
+    def __init__(self, path: str, _format: str, output: Optional[str], cached: bool, seconds: float, error: Optional[str] = None) -> None:
+        self.path = path
+        self.format = _format
+        self.output = output
+        self.cached = cached
+        self.seconds = seconds
+        self.error = error
+
+    def __repr__(self) -> str:
+        if self.error is not None:
+            return f"<ConversionJob {self.path} failed in {self.seconds:.3f}s: {self.error}>"
+        status = "cached" if self.cached else "converted"
+        return f"<ConversionJob {self.path} -> {self.output} ({status} in {self.seconds:.3f}s)>"
+
+
+def _content_hash(path: str, chunk_size: int = 1 << 20) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as _file:
+        for chunk in iter(lambda: _file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Runs in a worker process, so it has to be a module level function.
+def _convert_job(path: str, _format: str, cache_dir: str) -> ConversionJob:
+    start = time.perf_counter()
+    try:
+        output = os.path.join(cache_dir, f"{_content_hash(path)}.{_format}")
+        cached = os.path.exists(output)
+        if not cached:
+            result = VideoConverter(cache_dir).convert(path, _format)
+            # Write to a private temporary name and rename it into place, so other
+            # workers never see a half written cache entry.
+            temporary = f"{output}.{os.getpid()}.tmp"
+            result.save(temporary)
+            os.replace(temporary, output)
+    except Exception as error:
+        return ConversionJob(path, _format, None, False, time.perf_counter() - start, repr(error))
+    return ConversionJob(path, _format, output, cached, time.perf_counter() - start)
+
 
 class Application:
     def main(self):
@@ -1,9 +1,40 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import BinaryIO, Iterator, List, Optional, Tuple, Type
+
+from instrumentation import DISABLED, Instrumentation
+
+
 class File:
-    def __init__(self, filename: str) -> None:
-        self.data = open(filename)
+    _data: Optional[bytes]
+
+    # The contents are only read when somebody asks for them, so a File can be
+    # handed around (or streamed through `open`) without loading the video.
+    def __init__(self, filename: str, data: Optional[bytes] = None, instrumentation: Instrumentation = DISABLED) -> None:
+        self.filename = filename
+        self._data = data
+        self.instrumentation = instrumentation
+
+    @property
+    def data(self) -> bytes:
+        if self._data is None:
+            with self.open() as _file:
+                self._data = _file.read()
+        return self._data
+
+    def open(self) -> BinaryIO:
+        return open(self.filename, 'rb')
 
-    def save(self):
-        pass
+    def header(self, size: int) -> bytes:
+        if self._data is not None:
+            return self._data[:size]
+        with self.open() as _file:
+            return _file.read(size)
+
+    def save(self, filename: Optional[str] = None) -> None:
+        with self.instrumentation.stage("save") as stage, open(filename or self.filename, 'wb') as _file:
+            stage.bytes = _file.write(self.data)
 
 class VideoFile(File):
     pass
@@ -17,22 +48,111 @@ class OggCompressionCodec(Codec):
 class MPEG4CompressionCodec(Codec):
     name='MPEG4 Compression Codec'
 
+# Container signatures: the magic bytes found at a given offset at the start
+# of the file, and the codec they identify.
+SIGNATURES: List[Tuple[int, bytes, Type[Codec]]] = [
+    (0, b'OggS', OggCompressionCodec),
+    (4, b'ftyp', MPEG4CompressionCodec),
+]
+
 class CodecFactory:
-    def extract(self, _file: File) -> str:
-        return f"Extracting {_file.__dict__}"
+    instrumentation: Instrumentation
+
+    # Only the first few KB of a file are needed to recognise its container.
+    HEADER_SIZE = 4096
+
+    # Detected codecs by path, remembered with the file's mtime and size, so
+    # that converting the same input again skips detection entirely. A changed
+    # file replaces its entry; beyond `MAX_DETECTED` paths the least recently
+    # used ones are forgotten.
+    MAX_DETECTED = 4096
+    _detected: "OrderedDict[str, Tuple[int, int, Type[Codec]]]" = OrderedDict()
+    _detected_lock = threading.Lock()
+
+    def __init__(self, instrumentation: Instrumentation = DISABLED) -> None:
+        self.instrumentation = instrumentation
+
+    def extract(self, _file: File) -> Codec:
+        with self.instrumentation.stage("extract") as stage:
+            stat = os.stat(_file.filename)
+            path = os.path.abspath(_file.filename)
+            with self._detected_lock:
+                entry = self._detected.get(path)
+                if entry is not None and entry[:2] == (stat.st_mtime_ns, stat.st_size):
+                    self._detected.move_to_end(path)
+                    return entry[2]()
+            header = _file.header(self.HEADER_SIZE)
+            stage.bytes = len(header)
+            codec = self.sniff(header)
+            with self._detected_lock:
+                self._detected[path] = (stat.st_mtime_ns, stat.st_size, codec)
+                self._detected.move_to_end(path)
+                while len(self._detected) > self.MAX_DETECTED:
+                    self._detected.popitem(last=False)
+            return codec()
+
+    @staticmethod
+    def sniff(header: bytes) -> Type[Codec]:
+        for offset, magic, codec in SIGNATURES:
+            if header[offset:offset + len(magic)] == magic:
+                return codec
+        return Codec
 
 class Buffer:
-    pass
+    data: bytes
+    codec: Codec
+
+    def __init__(self, data: bytes, codec: Codec) -> None:
+        self.data = data
+        self.codec = codec
 
 class BitrateReader(Buffer):
     _file: File
-    def read(self, filename: str, sourceCodec: Codec) -> str:
+    instrumentation: Instrumentation
+
+    def __init__(self, instrumentation: Instrumentation = DISABLED) -> None:
+        self.instrumentation = instrumentation
+
+    def read(self, filename: str, sourceCodec: Codec) -> Buffer:
+        with self.instrumentation.stage("read") as stage:
+            self._file = File(filename)
+            data = self._file.data
+            stage.bytes = len(data)
+        return Buffer(data, sourceCodec)
+
+    def convert(self, buffer: Buffer, destinationCodec: Codec) -> Buffer:
+        with self.instrumentation.stage("convert") as stage:
+            stage.bytes = len(buffer.data)
+            return Buffer(buffer.data, destinationCodec)
+
+    # Streaming counterparts of `read` and `convert`: they hand out one chunk at
+    # a time instead of the whole video.
+    def read_chunks(self, filename: str, sourceCodec: Codec, chunk_size: int = 1 << 16) -> Iterator[Buffer]:
         self._file = File(filename)
-        return f"Reading {filename} with {sourceCodec.name}"
+        with self._file.open() as _file:
+            while True:
+                with self.instrumentation.stage("read") as stage:
+                    chunk = _file.read(chunk_size)
+                    stage.bytes = len(chunk)
+                if not chunk:
+                    return
+                yield Buffer(chunk, sourceCodec)
 
-    def convert(self, buffer: Buffer, destinationCodec: Codec) -> File:
-        return self._file
+    def convert_chunks(self, buffers: Iterator[Buffer], destinationCodec: Codec) -> Iterator[Buffer]:
+        for buffer in buffers:
+            yield self.convert(buffer, destinationCodec)
 
 class AudioMixer:
-    def fix(self, _file: File) -> str:
-        return f"Fixing {_file.__dict__}"
+    instrumentation: Instrumentation
+
+    def __init__(self, instrumentation: Instrumentation = DISABLED) -> None:
+        self.instrumentation = instrumentation
+
+    def fix(self, buffer: Buffer) -> bytes:
+        with self.instrumentation.stage("mix") as stage:
+            stage.bytes = len(buffer.data)
+            return buffer.data
+
+    def fix_chunks(self, buffers: Iterator[Buffer]) -> Iterator[bytes]:
+        for buffer in buffers:
+            yield self.fix(buffer)
@@ -0,0 +1,109 @@
+# Measures how many bytes each planted tree costs, how fast a viewport can pan
+# across the forest, how quickly a saved forest loads and how the texture pool
+# behaves under a memory budget. Run it from this directory:
+# `python benchmark.py [trees]` (defaults to 10^7 trees).
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from main import Forest, TexturePool, Tree, TreeFactory, TreeType
+
+SPECIES = [("oak", "green", "oak.png"), ("pine", "dark green", "pine.png"),
+           ("birch", "white", "birch.png"), ("maple", "red", "maple.png")]
+WORLD_SIZE = 100_000
+
+
+def plant(forest: Forest, count: int, seed: int = 42) -> Forest:
+    coordinates = random.Random(seed)
+    for _ in range(count):
+        forest.plantTree(coordinates.randrange(WORLD_SIZE), coordinates.randrange(WORLD_SIZE),
+                         *SPECIES[coordinates.randrange(len(SPECIES))])
+    return forest
+
+
+def benchmark_plant(count: int) -> None:
+    tracemalloc.start()
+    forest = plant(Forest(), count)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"Forest columns   {len(forest):>10} trees  {current / count:6.1f} bytes/tree")
+
+
+# The old layout for comparison: one Tree object per coordinate.
+def benchmark_objects(count: int) -> None:
+    coordinates = random.Random(42)
+    factory = TreeFactory()
+    tracemalloc.start()
+    trees = [Tree(coordinates.randrange(WORLD_SIZE), coordinates.randrange(WORLD_SIZE),
+                  factory.getTreeType(*SPECIES[coordinates.randrange(len(SPECIES))]))
+             for _ in range(count)]
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"Tree objects     {len(trees):>10} trees  {current / count:6.1f} bytes/tree")
+
+
+# Pans a 1920x1080 viewport diagonally across the world, one frame per step.
+def benchmark_pan(count: int, frames: int = 200) -> None:
+    forest = plant(Forest(), count)
+    start = time.perf_counter()
+    forest.draw("canvas", (0, 0, 1, 1))
+    print(f"Tile index       {len(forest):>10} trees  built in {time.perf_counter() - start:.2f}s")
+
+    step = (WORLD_SIZE - 1920) // frames
+    drawn = 0
+    start = time.perf_counter()
+    for frame in range(frames):
+        drawn += forest.draw("canvas", (frame * step, frame * step * 1080 // 1920, 1920, 1080))
+    seconds = time.perf_counter() - start
+    print(f"Panning          {frames:>10} frames {frames / seconds:8.1f} fps, {drawn / frames:.0f} trees/frame")
+
+    start = time.perf_counter()
+    forest.draw("canvas")
+    print(f"Full redraw      {len(forest):>10} trees  {time.perf_counter() - start:.2f}s/frame")
+
+
+# Bulk ingestion, then a save and a memory-mapped reopen of the same forest.
+def benchmark_file(count: int) -> None:
+    coordinates = random.Random(42)
+    rows = ((coordinates.randrange(WORLD_SIZE), coordinates.randrange(WORLD_SIZE),
+             *SPECIES[coordinates.randrange(len(SPECIES))]) for _ in range(count))
+    start = time.perf_counter()
+    forest = Forest()
+    forest.plant_many(rows)
+    print(f"plant_many       {len(forest):>10} trees  {time.perf_counter() - start:.2f}s")
+
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "forest.bin")
+        start = time.perf_counter()
+        forest.save(filename)
+        print(f"Save             {len(forest):>10} trees  {time.perf_counter() - start:.2f}s, "
+              f"{os.path.getsize(filename) / len(forest):.1f} bytes/tree on disk")
+        start = time.perf_counter()
+        opened = Forest.open(filename)
+        print(f"Open (mmap)      {len(opened):>10} trees  {(time.perf_counter() - start) * 1000:.2f}ms")
+        opened.close()
+
+
+# Draws batches of 64 tree types with 1 MiB textures under a 16 MiB budget.
+def benchmark_textures(draws: int = 10_000) -> None:
+    pool = TexturePool(loader=lambda texture: bytes(1 << 20), budget=16 << 20)
+    types = [TreeType(f"species {n}", "green", f"texture{n}.png", pool) for n in range(64)]
+    picks = random.Random(42)
+    start = time.perf_counter()
+    for _ in range(draws):
+        # Most frames show the same few species.
+        types[min(int(picks.expovariate(0.2)), len(types) - 1)].drawBatch("canvas", [(0, 0)])
+    seconds = time.perf_counter() - start
+    print(f"Texture pool     {draws:>10} draws  {seconds:.2f}s  {pool.stats()}")
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10 ** 7
+    benchmark_objects(min(count, 10 ** 6))
+    benchmark_plant(count)
+    benchmark_pan(count)
+    benchmark_file(count)
+    benchmark_textures()
@@ -7,7 +7,67 @@
 # can extract texture, color and other repeating data into a
 # separate object which lots of individual tree objects can
 # reference.
-from typing import Dict, Tuple
+import csv
+import mmap
+import os
+import struct
+import sys
+from array import array
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+from weakref import WeakValueDictionary
+
+
+def loadTexture(texture: str) -> bytes:
+    try:
+        with open(texture, 'rb') as _file:
+            return _file.read()
+    except FileNotFoundError:
+        # Missing textures are drawn with an empty placeholder bitmap.
+        return b''
+
+
+# Texture payloads are the BIG part of a tree type, and they can always be
+# loaded again from disk. The pool keeps the recently used ones in memory and,
+# when given a `budget` in bytes, evicts the least recently used payloads once
+# the resident size goes over it.
+class TexturePool:
+    _payloads: "OrderedDict[str, bytes]"
+
+    def __init__(self, loader: Callable[[str], bytes] = loadTexture, budget: Optional[int] = None):
+        self._loader = loader
+        self.budget = budget
+        self._payloads = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.residentBytes = 0
+
+    def get(self, texture: str) -> bytes:
+        payload = self._payloads.get(texture)
+        if payload is not None:
+            self.hits += 1
+            self._payloads.move_to_end(texture)
+            return payload
+
+        self.misses += 1
+        payload = self._loader(texture)
+        self._payloads[texture] = payload
+        self.residentBytes += len(payload)
+        # The payload that was just loaded stays, even if it alone is over budget.
+        while self.budget is not None and self.residentBytes > self.budget and len(self._payloads) > 1:
+            _, evicted = self._payloads.popitem(last=False)
+            self.residentBytes -= len(evicted)
+            self.evictions += 1
+        return payload
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "texture_hits": self.hits,
+            "texture_misses": self.misses,
+            "texture_evictions": self.evictions,
+            "texture_resident_bytes": self.residentBytes,
+        }
 
 
 class TreeType:
@@ -15,26 +75,50 @@ class TreeType:
     color: str
     texture: str
 
-    def __init__(self, name: str, color: str, texture: str):
+    def __init__(self, name: str, color: str, texture: str, textures: Optional[TexturePool] = None):
         self.name = name
         self.color = color
         self.texture = texture
+        self._textures = textures if textures is not None else TreeFactory.textures
 
     def draw(self, canvas, x, y):
-        return f"""Creating bitmap given type color and texture.
+        bitmap = self._textures.get(self.texture)
+        return f"""Creating {len(bitmap)} bytes bitmap given type color and texture.
         Drawing bitmap on {canvas} at {x} and {y}"""
 
+    # Draws many trees of this type at once, so the bitmap is created and its
+    # texture bound a single time for the whole batch.
+    def drawBatch(self, canvas, positions: Sequence[Tuple[int, int]]):
+        bitmap = self._textures.get(self.texture)
+        return f"""Creating {len(bitmap)} bytes bitmap given type color and texture.
+        Drawing bitmap on {canvas} at {len(positions)} positions"""
+
 
 # Flyweight factory decides whether to
 # flyweight or to create a new object.
+#
+# The factory only holds weak references to the types it handed out: a type
+# stays in the pool while some forest or tree uses it, and is garbage collected
+# with its texture reference once nobody does.
 class TreeFactory:
-    _treeTypes: Dict[Tuple[str, str, str], TreeType] = {}
+    _treeTypes: "WeakValueDictionary[Tuple[str, str, str], TreeType]" = WeakValueDictionary()
+    textures: TexturePool = TexturePool()
+    hits = 0
+    misses = 0
 
-    def getTreeType(self, name, color, texture):
+    def getTreeType(self, name, color, texture) -> TreeType:
         _type = self._treeTypes.get((name, color, texture))
         if _type is None:
-            _type = TreeType(name, color, texture)
+            TreeFactory.misses += 1
+            _type = TreeType(name, color, texture, self.textures)
             self._treeTypes[(name, color, texture)] = _type
+        else:
+            TreeFactory.hits += 1
+        return _type
+
+    @classmethod
+    def stats(cls) -> Dict[str, int]:
+        return {"types": len(cls._treeTypes), "hits": cls.hits, "misses": cls.misses, **cls.textures.stats()}
 
 
 # The contextual object contains the extrinsic part of the tree state. An
@@ -54,13 +138,230 @@ class Tree:
         return self._type.draw(canvas, self.x, self.y)
 
 
+# Even a small Tree object costs around a hundred bytes in Python, which adds
+# up on maps with millions of trees. So the forest moves the extrinsic state
+# into parallel columns instead: the coordinates and the id of the tree's type
+# live at the same index of three compact arrays (12 bytes per tree). The ids
+# point into the forest's own table of flyweights handed out by the factory.
+#
+# Forests can be saved to a compact binary file (see `save`) and opened again
+# through `mmap`, in which case the columns are views straight into the file
+# and nothing is parsed until a tree is actually looked at.
+#
+# For drawing, the map is split into square tiles of `tileSize` units. Each tile
+# keeps the row numbers of its trees grouped by type, so a frame only visits
+# the tiles that intersect the viewport and draws every type in one batch.
 class Forest:
-    _trees: Dict[Tuple[int, int], Tree] = {}
+    # Header: magic, version, number of tree types, number of trees. It is
+    # followed by the type table (three length-prefixed UTF-8 strings per
+    # type), padding up to a 4 byte boundary and the fixed-width little-endian
+    # (x, y, type_id) records.
+    _header = struct.Struct('<4sHxxIQ')
+    _string = struct.Struct('<H')
+    _record = struct.Struct('<iii')
+    MAGIC = b'FRST'
+    VERSION = 1
+
+    _types: List[TreeType]
+    _typeIds: Dict[Tuple[str, str, str], int]
+    _xs: Union[array, memoryview]
+    _ys: Union[array, memoryview]
+    _typeIdColumn: Union[array, memoryview]
+    _mmap: Optional[mmap.mmap]
+    _tiles: Dict[Tuple[int, int], Dict[int, array]]
+    _indexedRows: int
+
+    def __init__(self, tileSize: int = 256):
+        self._factory = TreeFactory()
+        self._types = []
+        self._typeIds = {}
+        self._xs = array('i')
+        self._ys = array('i')
+        self._typeIdColumn = array('i')
+        self._mmap = None
+        self.tileSize = tileSize
+        self._tiles = {}
+        self._indexedRows = 0
+
+    def getTypeId(self, name, color, texture) -> int:
+        typeId = self._typeIds.get((name, color, texture))
+        if typeId is None:
+            typeId = len(self._types)
+            self._types.append(self._factory.getTreeType(name, color, texture))
+            self._typeIds[(name, color, texture)] = typeId
+        return typeId
 
     def plantTree(self, x, y, name, color, texture):
-        _type = TreeFactory().getTreeType(name, color, texture)
-        self._trees[(x, y)] = Tree(x, y, _type)
+        self._makeWritable()
+        # Converting the whole row first means a bad value can't leave the
+        # columns with different lengths.
+        row = array('i', (x, y, self.getTypeId(name, color, texture)))
+        self._xs.append(row[0])
+        self._ys.append(row[1])
+        self._typeIdColumn.append(row[2])
 
-    def draw(self, canvas):
-        for tree in self._trees.values():
-            tree.draw(canvas)
+    # Bulk ingestion of (x, y, name, color, texture) rows, either from any
+    # iterable or from the path of a CSV file with those columns (a header row
+    # is skipped). Returns the number of planted trees.
+    def plant_many(self, trees: Union[Iterable[Sequence], str, os.PathLike]) -> int:
+        if isinstance(trees, (str, os.PathLike)):
+            with open(trees, newline='') as _file:
+                rows = csv.reader(_file)
+                first = next(rows, None)
+                planted = 0
+                if first is not None and first[0].lstrip('-').isdigit():
+                    planted = self.plant_many([first])
+                return planted + self.plant_many(rows)
+
+        self._makeWritable()
+        xs, ys, typeIds = self._xs, self._ys, self._typeIdColumn
+        getTypeId = self.getTypeId
+        planted = len(xs)
+        for x, y, name, color, texture in trees:
+            # Every value is converted and checked before anything is
+            # appended, so a bad row leaves the columns aligned.
+            x, y = int(x), int(y)
+            if not (-2 ** 31 <= x < 2 ** 31 and -2 ** 31 <= y < 2 ** 31):
+                raise OverflowError(f"coordinates ({x}, {y}) don't fit in a 32 bit column")
+            typeId = getTypeId(name, color, texture)
+            xs.append(x)
+            ys.append(y)
+            typeIds.append(typeId)
+        return len(xs) - planted
+
+    def save(self, filename: str) -> None:
+        count = len(self)
+        records = array('i', bytes(self._record.size * count))
+        for offset, column in enumerate((self._xs, self._ys, self._typeIdColumn)):
+            records[offset::3] = column if isinstance(column, array) else array('i', column)
+        if sys.byteorder == 'big':
+            records.byteswap()
+
+        with open(filename, 'wb') as _file:
+            _file.write(self._header.pack(self.MAGIC, self.VERSION, len(self._types), count))
+            for _type in self._types:
+                for value in (_type.name, _type.color, _type.texture):
+                    encoded = value.encode()
+                    _file.write(self._string.pack(len(encoded)) + encoded)
+            _file.write(bytes(-_file.tell() % 4))
+            records.tofile(_file)
+
+    @classmethod
+    def open(cls, filename: str, tileSize: int = 256) -> "Forest":
+        forest = cls(tileSize)
+        with open(filename, 'rb') as _file:
+            if os.fstat(_file.fileno()).st_size == 0:
+                raise ValueError(f"{filename} is not a forest file")
+            data = mmap.mmap(_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, typeCount, count = cls._header.unpack_from(data)
+        if magic != cls.MAGIC or version != cls.VERSION:
+            data.close()
+            raise ValueError(f"{filename} is not a version {cls.VERSION} forest file")
+        offset = cls._header.size
+        for _ in range(typeCount):
+            fields = []
+            for _ in range(3):
+                (length,) = cls._string.unpack_from(data, offset)
+                offset += cls._string.size
+                fields.append(bytes(data[offset:offset + length]).decode())
+                offset += length
+            forest.getTypeId(*fields)
+        offset += -offset % 4
+        if offset + cls._record.size * count > len(data):
+            data.close()
+            raise ValueError(f"{filename} is truncated: it should hold {count} trees")
+
+        view = memoryview(data)[offset:offset + cls._record.size * count].cast('i')
+        if sys.byteorder == 'little':
+            records = view
+            forest._mmap = data
+        else:
+            records = array('i', view)
+            records.byteswap()
+            view.release()
+            data.close()
+        forest._xs, forest._ys, forest._typeIdColumn = records[0::3], records[1::3], records[2::3]
+        return forest
+
+    # Columns that point into a memory-mapped file are read only. They are
+    # copied into arrays the first time the forest is modified.
+    def _makeWritable(self) -> None:
+        if self._mmap is None:
+            return
+        views = (self._xs, self._ys, self._typeIdColumn)
+        self._xs, self._ys, self._typeIdColumn = (array('i', view) for view in views)
+        self._release(views)
+
+    def close(self) -> None:
+        if self._mmap is not None:
+            views = (self._xs, self._ys, self._typeIdColumn)
+            self._xs, self._ys, self._typeIdColumn = array('i'), array('i'), array('i')
+            self._tiles, self._indexedRows = {}, 0
+            self._release(views)
+
+    def _release(self, views) -> None:
+        for view in views:
+            view.release()
+        self._mmap.close()
+        self._mmap = None
+
+    def __len__(self) -> int:
+        return len(self._xs)
+
+    # Context objects are only created on demand, for callers that want them.
+    def trees(self) -> Iterator[Tree]:
+        for x, y, typeId in zip(self._xs, self._ys, self._typeIdColumn):
+            yield Tree(x, y, self._types[typeId])
+
+    # The viewport is given as (x, y, width, height). Without one, the whole
+    # forest is drawn tree by tree. Returns how many trees were drawn.
+    def draw(self, canvas, viewport: Optional[Tuple[int, int, int, int]] = None) -> int:
+        if viewport is None:
+            types = self._types
+            for x, y, typeId in zip(self._xs, self._ys, self._typeIdColumn):
+                types[typeId].draw(canvas, x, y)
+            return len(self)
+
+        self._indexTiles()
+        left, top, width, height = viewport
+        right, bottom = left + width, top + height
+        size = self.tileSize
+        xs, ys = self._xs, self._ys
+        drawn = 0
+        for tileX in range(left // size, (right - 1) // size + 1):
+            for tileY in range(top // size, (bottom - 1) // size + 1):
+                tile = self._tiles.get((tileX, tileY))
+                if tile is None:
+                    continue
+                # Tiles on the border of the viewport may hold trees outside it.
+                inside = (left <= tileX * size and (tileX + 1) * size <= right
+                          and top <= tileY * size and (tileY + 1) * size <= bottom)
+                for typeId, rows in tile.items():
+                    if inside:
+                        positions = [(xs[row], ys[row]) for row in rows]
+                    else:
+                        positions = [(xs[row], ys[row]) for row in rows
+                                     if left <= xs[row] < right and top <= ys[row] < bottom]
+                    if positions:
+                        self._types[typeId].drawBatch(canvas, positions)
+                        drawn += len(positions)
+        return drawn
+
+    # Trees are only ever appended, so the tile index is brought up to date
+    # lazily by indexing the rows planted since the last draw.
+    def _indexTiles(self) -> None:
+        size = self.tileSize
+        tiles = self._tiles
+        start = self._indexedRows
+        for row in range(start, len(self._xs)):
+            key = (self._xs[row] // size, self._ys[row] // size)
+            tile = tiles.get(key)
+            if tile is None:
+                tile = tiles[key] = {}
+            typeId = self._typeIdColumn[row]
+            rows = tile.get(typeId)
+            if rows is None:
+                rows = tile[typeId] = array('I')
+            rows.append(row)
+        self._indexedRows = len(self._xs)
@@ -0,0 +1,181 @@
+# Shows how much latency the caching proxy saves in front of a slow service,
+# how many backend calls it avoids when a hot video is stampeded, and the
+# throughput of the async client and proxy against a local fake server, and the
+# resumable download cache and batched metadata lookups.
+# Run it from this directory: `python benchmark.py`.
+import asyncio
+import os
+import random
+import tempfile
+import threading
+import time
+
+from fake_server import FakeYoutubeServer, FileServingYoutube
+from main import AsyncCachedYoutubeClass, AsyncYoutubeClient, AsyncYoutubeManager, CachedYoutubeClass, DownloadCache, ThirdPartyYoutubeClass, YoutubeManager
+
+
+# Stands in for the real YouTube API: every call pays a fixed network delay.
+class SlowYoutubeClass(ThirdPartyYoutubeClass):
+    def __init__(self, latency: float = 0.005):
+        self.latency = latency
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _request(self) -> None:
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.latency)
+
+    def listVideos(self):
+        self._request()
+        return super().listVideos()
+
+    def getVideoInfo(self, video_id):
+        self._request()
+        return super().getVideoInfo(video_id)
+
+    # The batch endpoint costs a single round trip.
+    def get_video_infos(self, video_ids):
+        self._request()
+        return {video_id: ThirdPartyYoutubeClass.getVideoInfo(self, video_id) for video_id in video_ids}
+
+
+# A service without a batch endpoint, for comparison.
+class UnbatchedSlowYoutubeClass(SlowYoutubeClass):
+    def get_video_infos(self, video_ids):
+        return ThirdPartyYoutubeClass.get_video_infos(self, video_ids)
+
+
+def benchmark_cache(requests: int = 2_000, videos: int = 5_000, max_entries: int = 1_000) -> None:
+    # Popularity follows a Zipf-like distribution, as it does on real sites.
+    ids = random.Random(42).choices(range(videos), weights=[1 / (rank + 1) for rank in range(videos)], k=requests)
+    for label, service in (("direct", SlowYoutubeClass()), ("proxy", None)):
+        backend = service or SlowYoutubeClass()
+        client = service or CachedYoutubeClass(backend, max_entries=max_entries)
+        start = time.perf_counter()
+        for video_id in ids:
+            client.getVideoInfo(video_id)
+        seconds = time.perf_counter() - start
+        print(f"{label:<8} {seconds / requests * 1000:6.3f} ms/request  {backend.calls:>6} backend calls")
+        if service is None:
+            print(f"         {client.stats()['video']}")
+
+
+# Many threads ask for the same hot video at the same moment, right after its
+# cache entry expired (or was never there).
+def benchmark_stampede(threads: int = 64, rounds: int = 5) -> None:
+    for label, make_client in (("direct", lambda backend: backend), ("proxy", CachedYoutubeClass)):
+        backend = SlowYoutubeClass(latency=0.05)
+        start = time.perf_counter()
+        for _ in range(rounds):
+            client = make_client(backend)
+            barrier = threading.Barrier(threads)
+
+            def request():
+                barrier.wait()
+                client.getVideoInfo("hot video")
+
+            workers = [threading.Thread(target=request) for _ in range(threads)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        seconds = time.perf_counter() - start
+        print(f"{label:<8} {threads} threads x {rounds} stampedes: {backend.calls:>4} backend calls, {seconds:.2f}s")
+
+
+# Requests per second through the async client against the local fake server,
+# first sequentially, then fanned out over the connection pool, then behind the
+# async caching proxy.
+async def benchmark_async(requests: int = 1_000, videos: int = 200, pool_size: int = 16) -> None:
+    ids = [str(video_id) for video_id in random.Random(42).choices(range(videos), k=requests)]
+    async with FakeYoutubeServer(latency=0.005) as server:
+        client = AsyncYoutubeClient(server.host, server.port, pool_size)
+
+        start = time.perf_counter()
+        for video_id in ids[:100]:
+            await client.getVideoInfo(video_id)
+        print(f"async sequential  {100 / (time.perf_counter() - start):8.0f} req/s")
+
+        for label, service in (("async pooled", client), ("async proxy", AsyncCachedYoutubeClass(client))):
+            before = server.requests
+            start = time.perf_counter()
+            await asyncio.gather(*(service.getVideoInfo(video_id) for video_id in ids))
+            seconds = time.perf_counter() - start
+            print(f"{label:<17} {requests / seconds:8.0f} req/s  {server.requests - before:>5} backend requests")
+
+        manager = AsyncYoutubeManager(client)
+        start = time.perf_counter()
+        for video_id in ids[:100]:
+            await manager.react_on_user_input(video_id)
+        print(f"manager fan-out   {100 / (time.perf_counter() - start):8.0f} pages/s")
+        await client.close()
+
+
+# Downloads through the disk cache from a local file server whose connection
+# drops halfway through the first video, then checks resume, hits and quota.
+def benchmark_downloads(videos: int = 8, size: int = 4 << 20) -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        served = os.path.join(directory, "served")
+        os.makedirs(served)
+        for n in range(videos):
+            with open(os.path.join(served, f"video{n}"), 'wb') as _file:
+                _file.write(os.urandom(size))
+
+        service = FileServingYoutube(served, fail_after=size // 2)
+        cache = DownloadCache(os.path.join(directory, "cache"), quota=size * videos // 2)
+        proxy = CachedYoutubeClass(service, download_cache=cache)
+        try:
+            proxy.download_path("video0")
+        except ConnectionResetError:
+            print(f"download dropped after {service.bytes_sent} bytes")
+        path = proxy.download_path("video0")
+        with open(os.path.join(served, "video0"), 'rb') as original, open(path, 'rb') as cached:
+            assert original.read() == cached.read()
+        print(f"resumed: {service.bytes_sent} bytes sent in total for a {size} byte video")
+
+        start = time.perf_counter()
+        for n in range(videos):
+            proxy.download_path(f"video{n}")
+        cold = time.perf_counter() - start
+        start = time.perf_counter()
+        proxy.download_path(f"video{videos - 1}")
+        warm = time.perf_counter() - start
+        print(f"cold downloads {cold / videos * 1000:.2f} ms/video, cached hit {warm * 1000:.3f} ms, "
+              f"{cache.usage()} bytes on disk (quota {cache.quota})")
+
+
+# Renders a list panel of 100 videos, and lets 100 threads look up different
+# videos at once through a proxy that batches its misses.
+def benchmark_batching(videos: int = 100) -> None:
+    class ListingService(SlowYoutubeClass):
+        def listVideos(self):
+            self._request()
+            return [f"video_{n}" for n in range(videos)]
+
+    class UnbatchedListingService(ListingService, UnbatchedSlowYoutubeClass):
+        pass
+
+    for label, backend in (("panel per id", UnbatchedListingService()), ("panel batched", ListingService())):
+        start = time.perf_counter()
+        YoutubeManager(CachedYoutubeClass(backend)).render_list_panel()
+        print(f"{label:<14} {(time.perf_counter() - start) * 1000:7.1f} ms  {backend.calls:>4} backend calls")
+
+    for label, window in (("threads direct", None), ("threads batched", 0.002)):
+        backend = SlowYoutubeClass()
+        proxy = CachedYoutubeClass(backend, batch_window=window)
+        workers = [threading.Thread(target=proxy.getVideoInfo, args=(f"video_{n}",)) for n in range(videos)]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        print(f"{label:<14} {(time.perf_counter() - start) * 1000:7.1f} ms  {backend.calls:>4} backend calls")
+
+
+if __name__ == "__main__":
+    benchmark_cache()
+    benchmark_stampede()
+    asyncio.run(benchmark_async())
+    benchmark_downloads()
+    benchmark_batching()
@@ -0,0 +1,84 @@
+# A local stand-in for the YouTube API, used by the benchmarks. It serves any
+# ThirdPartyYoutubeLib over the line protocol AsyncYoutubeClient speaks and
+# waits `latency` seconds before answering each request, like a remote service
+# would. No third party HTTP library is needed.
+import asyncio
+import os
+from typing import Optional
+
+from main import ThirdPartyYoutubeClass, ThirdPartyYoutubeLib
+
+
+class FakeYoutubeServer:
+    _server: Optional[asyncio.AbstractServer]
+
+    def __init__(self, service: ThirdPartyYoutubeLib = None, latency: float = 0.01):
+        self._service = service or ThirdPartyYoutubeClass()
+        self.latency = latency
+        self.requests = 0
+        self.host = "127.0.0.1"
+        self.port = 0
+        self._server = None
+
+    async def start(self) -> "FakeYoutubeServer":
+        self._server = await asyncio.start_server(self._handle, self.host, 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def close(self) -> None:
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def __aenter__(self) -> "FakeYoutubeServer":
+        return await self.start()
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while line := await reader.readline():
+                method, _, argument = line.decode().rstrip("\n").partition(" ")
+                self.requests += 1
+                await asyncio.sleep(self.latency)
+                try:
+                    if method == "listVideos":
+                        body = "\n".join(self._service.listVideos())
+                    elif method in ("getVideoInfo", "downloadVideo"):
+                        body = getattr(self._service, method)(argument)
+                    else:
+                        raise ValueError(f"Unknown method {method}")
+                    status = b"OK"
+                except Exception as error:
+                    status, body = b"ERR", str(error)
+                if isinstance(body, str):
+                    body = body.encode()
+                writer.write(status + b" %d\n" % len(body) + body)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+# Serves videos from files in a directory, streaming them in chunks. To
+# simulate dropped connections it can fail once after `fail_after` bytes.
+class FileServingYoutube(ThirdPartyYoutubeClass):
+    def __init__(self, directory: str, chunk_size: int = 1 << 16, fail_after: Optional[int] = None):
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.fail_after = fail_after
+        self.bytes_sent = 0
+
+    def downloadVideo(self, video_id):
+        return b"".join(self.streamVideo(video_id))
+
+    def streamVideo(self, video_id, offset: int = 0):
+        with open(os.path.join(self.directory, video_id), 'rb') as _file:
+            _file.seek(offset)
+            for chunk in iter(lambda: _file.read(self.chunk_size), b''):
+                if self.fail_after is not None and self.bytes_sent >= self.fail_after:
+                    self.fail_after = None
+                    raise ConnectionResetError("Connection dropped")
+                self.bytes_sent += len(chunk)
+                yield chunk
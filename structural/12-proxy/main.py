@@ -1,5 +1,12 @@
+import asyncio
+import hashlib
+import os
+import threading
+import time
 from abc import ABC, abstractmethod
-from typing import List
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Hashable, Iterable, Iterator, List, Optional, Tuple
 
 class ThirdPartyYoutubeLib(ABC):
     @abstractmethod
@@ -14,6 +21,20 @@ class ThirdPartyYoutubeLib(ABC):
     def downloadVideo(self, video_id):
         pass
 
+    # Metadata of several videos in one round trip, keyed by id. Services
+    # without a batch endpoint fall back to one request per video.
+    def get_video_infos(self, video_ids: Iterable) -> Dict[Any, Any]:
+        return {video_id: self.getVideoInfo(video_id) for video_id in video_ids}
+
+    # Streams the video's bytes starting at `offset`, so an interrupted
+    # download can be resumed. Services that can't do better fall back to
+    # slicing a full download.
+    def streamVideo(self, video_id, offset: int = 0) -> Iterator[bytes]:
+        content = self.downloadVideo(video_id)
+        if isinstance(content, str):
+            content = content.encode()
+        yield content[offset:]
+
 # The concrete implementation of a service connector. Methods of this class can
 # request information from YouTube. The speed of the request depends on a
 # user's internet connection as well as YouTube's. The application will slow down
@@ -21,7 +42,8 @@ class ThirdPartyYoutubeLib(ABC):
 # same information.
 class ThirdPartyYoutubeClass(ThirdPartyYoutubeLib):
     def listVideos(self):
-        return "Sending and API request to Youtube"
+        # Sending and API request to Youtube
+        return [f"video_{n}" for n in range(10)]
 
     def getVideoInfo(self, video_id):
         return f"Getting metadata about {video_id}"
@@ -30,32 +52,317 @@ class ThirdPartyYoutubeClass(ThirdPartyYoutubeLib):
         return f"Downloading {video_id}"
 
 
+# A bounded cache: entries expire `ttl` seconds after they were stored, and once
+# there are more than `max_entries` the least recently used one is evicted. It
+# is safe to share between threads.
+class LRUCache:
+    MISSING = object()
+    _entries: "OrderedDict[Hashable, Tuple[float, Any]]"
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 300.0, clock: Callable[[], float] = time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: Hashable) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > self._clock():
+                    self.hits += 1
+                    self._entries.move_to_end(key)
+                    return value
+                del self._entries[key]
+                self.expirations += 1
+            self.misses += 1
+            return self.MISSING
+
+    def put(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._entries[key] = (self._clock() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, int]:
+        return {"entries": len(self), "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "expirations": self.expirations}
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+# Request coalescing: while a call for some key is in flight, other threads
+# asking for the same key wait for it and share its result instead of sending
+# their own request.
+class SingleFlight:
+    _calls: Dict[Hashable, _Call]
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except BaseException as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+# Downloaded videos are stored on disk by the SHA-256 of their content, so two
+# ids with the same video share one file. A download is streamed into a partial
+# file named after the video id; if it gets interrupted, the next attempt
+# resumes from the partial file's size. Once complete it is renamed into place
+# atomically. Files are evicted least recently used first when the cache grows
+# over `quota` bytes.
+class DownloadCache:
+    def __init__(self, directory: str, quota: int):
+        self.directory = directory
+        self.quota = quota
+        for subdirectory in ("objects", "partial", "index"):
+            os.makedirs(os.path.join(directory, subdirectory), exist_ok=True)
+
+    def _name(self, video_id) -> str:
+        return hashlib.sha256(str(video_id).encode()).hexdigest()
+
+    # Returns the cached file of a video, or None if it isn't cached.
+    def get(self, video_id) -> Optional[str]:
+        try:
+            with open(os.path.join(self.directory, "index", self._name(video_id))) as _file:
+                path = os.path.join(self.directory, "objects", _file.read())
+            # The modification time doubles as the last access time for eviction.
+            os.utime(path)
+            return path
+        except FileNotFoundError:
+            return None
+
+    def fetch(self, video_id, stream: Callable[[int], Iterator[bytes]]) -> str:
+        name = self._name(video_id)
+        partial = os.path.join(self.directory, "partial", name)
+        digest = hashlib.sha256()
+        with open(partial, 'a+b') as _file:
+            _file.seek(0)
+            for chunk in iter(lambda: _file.read(1 << 20), b''):
+                digest.update(chunk)
+            for chunk in stream(_file.tell()):
+                _file.write(chunk)
+                digest.update(chunk)
+            _file.flush()
+            os.fsync(_file.fileno())
+
+        path = os.path.join(self.directory, "objects", digest.hexdigest())
+        os.replace(partial, path)
+        index = os.path.join(self.directory, "index", name)
+        with open(f"{index}.tmp", 'w') as _file:
+            _file.write(digest.hexdigest())
+        os.replace(f"{index}.tmp", index)
+        self.evict(keep=path)
+        return path
+
+    def evict(self, keep: Optional[str] = None) -> None:
+        objects = os.path.join(self.directory, "objects")
+        entries = [entry for entry in os.scandir(objects) if entry.is_file()]
+        used = sum(entry.stat().st_size for entry in entries)
+        for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime_ns):
+            if used <= self.quota:
+                break
+            if entry.path != keep:
+                used -= entry.stat().st_size
+                os.remove(entry.path)
+
+    def usage(self) -> int:
+        return sum(entry.stat().st_size for entry in os.scandir(os.path.join(self.directory, "objects")))
+
+
+# Gathers the individual lookups made within `window` seconds of each other
+# (or until `max_batch` of them are pending) and sends them to the service as
+# a single `fetch_many` call. Every caller blocks until its batch is back.
+class RequestBatcher:
+    _pending: Dict[Hashable, _Call]
+    _timer: Optional[threading.Timer]
+
+    def __init__(self, fetch_many: Callable[[List[Hashable]], Dict[Hashable, Any]], window: float = 0.002, max_batch: int = 100):
+        self._fetch_many = fetch_many
+        self.window = window
+        self.max_batch = max_batch
+        self._pending = {}
+        self._timer = None
+        self._lock = threading.Lock()
+        self.batches = 0
+
+    def get(self, key: Hashable) -> Any:
+        flush_now = False
+        with self._lock:
+            call = self._pending.get(key)
+            if call is None:
+                call = self._pending[key] = _Call()
+                if len(self._pending) >= self.max_batch:
+                    flush_now = True
+                elif self._timer is None:
+                    self._timer = threading.Timer(self.window, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+        if flush_now:
+            self.flush()
+
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def flush(self) -> None:
+        with self._lock:
+            batch, self._pending = self._pending, {}
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if not batch:
+            return
+
+        self.batches += 1
+        try:
+            results = self._fetch_many(list(batch))
+        except BaseException as error:
+            for call in batch.values():
+                call.error = error
+                call.done.set()
+            return
+        for key, call in batch.items():
+            if key in results:
+                call.result = results[key]
+            else:
+                call.error = KeyError(key)
+            call.done.set()
+
+
 # To save some bandwidth, we can cache request results and keep them for some time. But it may be impossible to put such code directly into the service class. For example, it could have // been provided as part of a third party library and/or defined as `final`. That's why we put the caching code into a new
 # proxy class which implements the same interface as the
 # service class. It delegates to the service object only when the real requests have to be sent.
+#
+# Video metadata is cached per `video_id`, so asking about one video never
+# returns the answer for another. Concurrent misses for the same key share a
+# single request to the service. With a `batch_window`, misses for different
+# videos made at about the same time travel to the service as one
+# `get_video_infos` call. Downloads are kept in an optional on-disk
+# DownloadCache.
 class CachedYoutubeClass(ThirdPartyYoutubeLib):
     _service: ThirdPartyYoutubeLib
-    _list_cache: List[str]
-    _video_cache: List[str]
-    _download_exists: bool
+    _list_cache: LRUCache
+    _video_cache: LRUCache
+    _download_cache: Optional[DownloadCache]
     needReset: bool
 
-    def __init__(self, service: ThirdPartyYoutubeLib):
+    def __init__(self, service: ThirdPartyYoutubeLib, max_entries: int = 1024, ttl: float = 300.0, clock: Callable[[], float] = time.monotonic, download_cache: Optional[DownloadCache] = None, batch_window: Optional[float] = None):
         self._service = service
+        self._list_cache = LRUCache(1, ttl, clock)
+        self._video_cache = LRUCache(max_entries, ttl, clock)
+        self._in_flight = SingleFlight()
+        self._download_cache = download_cache
+        self._batcher = None if batch_window is None else RequestBatcher(service.get_video_infos, batch_window)
+        self.needReset = False
 
     def listVideos(self):
-        if not self._list_cache or self.needReset:
-            self._list_cache = self._service.listVideos()
-        return self._list_cache
+        return self._cached("list", self._list_cache, None, self._service.listVideos)
 
     def getVideoInfo(self, video_id):
-        if not self._video_cache or self.needReset:
-            self._video_cache = self._service.getVideoInfo(video_id)
-        return self._video_cache
+        if self._batcher is not None:
+            return self._cached("video", self._video_cache, video_id, lambda: self._batcher.get(video_id))
+        return self._cached("video", self._video_cache, video_id, lambda: self._service.getVideoInfo(video_id))
+
+    # Serves what it can from the cache and asks the service for all the
+    # missing videos in a single call.
+    def get_video_infos(self, video_ids: Iterable) -> Dict[Any, Any]:
+        video_infos = {}
+        missing = []
+        for video_id in video_ids:
+            video_info = LRUCache.MISSING if self.needReset else self._video_cache.get(video_id)
+            if video_info is LRUCache.MISSING:
+                missing.append(video_id)
+            else:
+                video_infos[video_id] = video_info
+        if missing:
+            for video_id, video_info in self._service.get_video_infos(missing).items():
+                self._video_cache.put(video_id, video_info)
+                video_infos[video_id] = video_info
+        return video_infos
+
+    def _cached(self, kind: str, cache: LRUCache, key: Hashable, fetch: Callable[[], Any]) -> Any:
+        value = LRUCache.MISSING if self.needReset else cache.get(key)
+        if value is LRUCache.MISSING:
+            value = self._in_flight.do((kind, key), lambda: self._fetch(cache, key, fetch))
+        return value
+
+    def _fetch(self, cache: LRUCache, key: Hashable, fetch: Callable[[], Any]) -> Any:
+        value = fetch()
+        cache.put(key, value)
+        return value
+
+    # Drops the cached metadata of one video (and the video list, which may
+    # mention it), or everything when no `video_id` is given.
+    def invalidate(self, video_id=None) -> None:
+        self._list_cache.clear()
+        if video_id is None:
+            self._video_cache.clear()
+        else:
+            self._video_cache.invalidate(video_id)
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {"list": self._list_cache.stats(), "video": self._video_cache.stats()}
 
     def downloadVideo(self, video_id):
-        if not self._download_exists or self.needReset:
-            self._downloadCache = self._service.downloadVideo(video_id)
+        if self._download_cache is None:
+            return self._service.downloadVideo(video_id)
+        with open(self.download_path(video_id), 'rb') as _file:
+            return _file.read()
+
+    # Path of the cached copy of a video, downloading it first if needed.
+    def download_path(self, video_id) -> str:
+        path = None if self.needReset else self._download_cache.get(video_id)
+        if path is None:
+            path = self._in_flight.do(("download", video_id), lambda: self._download_cache.fetch(
+                video_id, lambda offset: self._service.streamVideo(video_id, offset)))
+        return path
 
 
 class YoutubeManager:
@@ -68,15 +375,166 @@ class YoutubeManager:
         video_info = self._service.getVideoInfo(video_id)
         return f"<html><body>{video_info}</body></html>"
 
+    # The panel shows every listed video, so their metadata is fetched up front
+    # in one batch instead of one round trip per video.
     def render_list_panel(self):
         video_list = self._service.listVideos()
-        return f"<html><body>{video_list}</body></html>"
+        video_infos = self._service.get_video_infos(video_list)
+        items = "".join(f"<li>{video_infos[video_id]}</li>" for video_id in video_list)
+        return f"<html><body><ul>{items}</ul></body></html>"
 
     def react_on_user_input(self, video_id: str):
         self.render_video_page(video_id)
         self.render_list_panel()
 
 
+# The same library interface for asyncio code: every call is a coroutine, so a
+# client can have many requests in flight at once.
+class AsyncThirdPartyYoutubeLib(ABC):
+    @abstractmethod
+    async def listVideos(self):
+        pass
+
+    @abstractmethod
+    async def getVideoInfo(self, video_id):
+        pass
+
+    @abstractmethod
+    async def downloadVideo(self, video_id):
+        pass
+
+    async def get_video_infos(self, video_ids: Iterable) -> Dict[Any, Any]:
+        video_ids = list(video_ids)
+        return dict(zip(video_ids, await asyncio.gather(*(self.getVideoInfo(video_id) for video_id in video_ids))))
+
+
+# Keeps up to `size` open connections to the service and reuses them between
+# requests. When all of them are busy, further requests wait for a free one.
+class ConnectionPool:
+    _idle: List[Tuple[asyncio.StreamReader, asyncio.StreamWriter]]
+
+    def __init__(self, host: str, port: int, size: int = 8):
+        self.host = host
+        self.port = port
+        self._idle = []
+        self._slots = asyncio.Semaphore(size)
+
+    @asynccontextmanager
+    async def connection(self) -> AsyncIterator[Tuple[asyncio.StreamReader, asyncio.StreamWriter]]:
+        async with self._slots:
+            if self._idle:
+                connection = self._idle.pop()
+            else:
+                connection = await asyncio.open_connection(self.host, self.port)
+            try:
+                yield connection
+            except BaseException:
+                # The connection may be in the middle of a response; drop it.
+                connection[1].close()
+                raise
+            self._idle.append(connection)
+
+    async def close(self) -> None:
+        while self._idle:
+            _, writer = self._idle.pop()
+            writer.close()
+            await writer.wait_closed()
+
+
+# Service connector speaking a tiny line protocol: the request is
+# "<method> <argument>\n" and the response is "<OK|ERR> <length>\n" followed by
+# `length` bytes of body (see fake_server.py for a local stand-in).
+class AsyncYoutubeClient(AsyncThirdPartyYoutubeLib):
+    def __init__(self, host: str, port: int, pool_size: int = 8):
+        self._pool = ConnectionPool(host, port, pool_size)
+
+    async def listVideos(self):
+        return (await self._request("listVideos")).decode().splitlines()
+
+    async def getVideoInfo(self, video_id):
+        return (await self._request("getVideoInfo", video_id)).decode()
+
+    async def downloadVideo(self, video_id):
+        return await self._request("downloadVideo", video_id)
+
+    async def close(self) -> None:
+        await self._pool.close()
+
+    async def _request(self, method: str, argument: str = "") -> bytes:
+        async with self._pool.connection() as (reader, writer):
+            writer.write(f"{method} {argument}\n".encode())
+            await writer.drain()
+            status, length = (await reader.readline()).split()
+            body = await reader.readexactly(int(length))
+        if status != b"OK":
+            raise RuntimeError(body.decode())
+        return body
+
+
+# The async proxy caches like CachedYoutubeClass. Concurrent misses for the
+# same key await one shared task; it is shielded so that a cancelled caller
+# doesn't cancel the request the others are waiting for.
+class AsyncCachedYoutubeClass(AsyncThirdPartyYoutubeLib):
+    _service: AsyncThirdPartyYoutubeLib
+    _in_flight: Dict[Hashable, "asyncio.Task"]
+
+    def __init__(self, service: AsyncThirdPartyYoutubeLib, max_entries: int = 1024, ttl: float = 300.0, clock: Callable[[], float] = time.monotonic):
+        self._service = service
+        self._list_cache = LRUCache(1, ttl, clock)
+        self._video_cache = LRUCache(max_entries, ttl, clock)
+        self._in_flight = {}
+
+    async def listVideos(self):
+        return await self._cached("list", self._list_cache, None, self._service.listVideos)
+
+    async def getVideoInfo(self, video_id):
+        return await self._cached("video", self._video_cache, video_id, lambda: self._service.getVideoInfo(video_id))
+
+    async def downloadVideo(self, video_id):
+        return await self._service.downloadVideo(video_id)
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {"list": self._list_cache.stats(), "video": self._video_cache.stats()}
+
+    async def _cached(self, kind: str, cache: LRUCache, key: Hashable, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        value = cache.get(key)
+        if value is not LRUCache.MISSING:
+            return value
+        task = self._in_flight.get((kind, key))
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(cache, key, fetch))
+            self._in_flight[(kind, key)] = task
+            task.add_done_callback(lambda _: self._in_flight.pop((kind, key), None))
+        return await asyncio.shield(task)
+
+    async def _fetch(self, cache: LRUCache, key: Hashable, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        value = await fetch()
+        cache.put(key, value)
+        return value
+
+
+# The async manager renders the page and the list panel concurrently instead of
+# one after the other.
+class AsyncYoutubeManager:
+    _service: AsyncThirdPartyYoutubeLib
+
+    def __init__(self, service: AsyncThirdPartyYoutubeLib):
+        self._service = service
+
+    async def render_video_page(self, video_id: str):
+        video_info = await self._service.getVideoInfo(video_id)
+        return f"<html><body>{video_info}</body></html>"
+
+    async def render_list_panel(self):
+        video_list = await self._service.listVideos()
+        video_infos = await self._service.get_video_infos(video_list)
+        items = "".join(f"<li>{video_infos[video_id]}</li>" for video_id in video_list)
+        return f"<html><body><ul>{items}</ul></body></html>"
+
+    async def react_on_user_input(self, video_id: str):
+        return await asyncio.gather(self.render_video_page(video_id), self.render_list_panel())
+
+
 class Application:
     def __init__(self):
         a_youtube_service = ThirdPartyYoutubeClass()